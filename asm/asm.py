@@ -16,6 +16,7 @@
 
 import sys
 import re
+from collections import namedtuple
 
 # Opcodes
 OPCODES = {
@@ -59,16 +60,46 @@ OPCODES = {
 # Capturing groups: label, opcode, operandA, operandB
 REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
 
-# Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+# Compiled once, used for every line
+LINE = re.compile(REGEX)
+
+# Kinds of parsed line
+OP = "OP"  # an instruction
+DS = "DS"  # a string of data bytes
+DB = "DB"  # a single data byte
+
+# One parsed source line. kind is OP, DS or DB, or None for a line with no
+# statement (blank, a comment, or just a label). data is the argument of DS
+# or DB, as written (None if missing).
+Line = namedtuple("Line", ["line_num", "label", "kind", "opcode", "op_a",
+                           "op_b", "data"])
+
+# Register names, e.g. "R2" -> 2
+REGISTERS = {f"R{i}": i for i in range(8)}
+
+
+class AsmError(Exception):
+    """
+    A mistake in the source being assembled. The message says what and
+    where; status is the exit code asm.py exits with.
+    """
+
+    def __init__(self, message, status=2):
+        super().__init__(message)
+        self.status = status
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [--binary] [-O] [inputfile] [outputfile]
     """
 
+    # --binary writes raw bytes instead of .ls8 text
+    binary = "--binary" in argv
+    # -O runs the peephole optimizer
+    optimize = "-O" in argv
+    argv = [a for a in argv if a not in ("--binary", "-O")]
+
     if len(argv) == 1:
         inputfile = "-"
         outputfile = "-"
@@ -82,16 +113,18 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [--binary] [-O] [infile.asm] [outfile.ls8]",
+              file=sys.stderr)
         sys.exit(1)
 
-    return inputfile, outputfile
+    return inputfile, outputfile, binary, optimize
 
 
-def open_files(inputfile, outputfile):
+def open_files(inputfile, outputfile, binary=False):
     """
     Open files for reading and writing. If either of the files are named "-",
-    stdin or stdout is returned as appropriate.
+    stdin or stdout is returned as appropriate. With binary, the output is
+    opened for writing bytes.
     """
 
     if inputfile == "-":
@@ -100,39 +133,442 @@ def open_files(inputfile, outputfile):
         inputfile = open(inputfile)
 
     if outputfile == "-":
-        outputfile = sys.stdout
+        outputfile = sys.stdout.buffer if binary else sys.stdout
     else:
-        outputfile = open(outputfile, "w")
+        outputfile = open(outputfile, "wb" if binary else "w")
 
     return inputfile, outputfile
 
 
-def normalize_line(groups):
+def parse(inputfile):
     """
-    Takes match groups and uppercases them if they're not None.
+    Scan source lines (a file or any iterable of strings) and generate one
+    Line for each. Each line is matched once; names are uppercased.
     """
 
-    result = []
+    line_num = 0
+
+    for line in inputfile:
+        line_num += 1
+
+        # Strip comments
+        comment_index = line.find(';')
+        if comment_index != -1:
+            line = line[:comment_index]
+
+        # Normalize
+        line = line.strip()
+
+        m = LINE.match(line)
+        label, opcode, op_a, op_b = m.groups()
+
+        if label is not None:
+            label = label.upper()
+        data = None
+
+        if opcode is None:
+            kind = None
 
-    for g in groups:
-        if g is None:
-            result.append(None)
         else:
-            result.append(g.upper())
+            opcode = opcode.upper()
+
+            if opcode == DS or opcode == DB:
+                kind = opcode
+                # The argument is the rest of the line, case and all
+                data = line[m.end(2):].lstrip() or None
+                op_a = op_b = None
+
+            else:
+                kind = OP
+                if op_a is not None:
+                    op_a = op_a.upper()
+                if op_b is not None:
+                    op_b = op_b.upper()
+
+        yield Line(line_num, label, kind, opcode, op_a, op_b, data)
+
+
+# Optimizer tables
+
+# Instructions that write the register in their first operand
+WRITES_A = {"ADD", "AND", "DEC", "DIV", "INC", "LD", "LDI", "MOD", "MUL",
+            "NOT", "OR", "POP", "SHL", "SHR", "SUB", "XOR"}
+
+# Instructions that only read their first operand (the rest of the type 1
+# and 2 instructions read all of their register operands)
+NO_READ_A = {"LD", "LDI", "POP"}
+
+# Instructions that use the stack pointer, R7
+SP = 7
+STACK_OPS = {"CALL", "INT", "IRET", "POP", "PUSH", "RET"}
+
+# Instructions that may not carry on to the next line
+BRANCHES = {"CALL", "HLT", "INT", "IRET", "JEQ", "JGE", "JGT", "JLE", "JLT",
+            "JMP", "JNE", "RET"}
+
+# Bytes taken by each opcode type
+TYPE_SIZES = {0: 1, 1: 2, 2: 3, 8: 3}
+
+
+def line_size(line):
+    """Bytes of machine code a parsed line assembles to."""
+
+    if line.kind == OP:
+        op_info = OPCODES.get(line.opcode)
+        return 0 if op_info is None else TYPE_SIZES[op_info["type"]]
+
+    if line.kind == DS:
+        return len(line.data or "")
+
+    if line.kind == DB:
+        return 1
+
+    return 0
+
+
+def line_regs(line):
+    """
+    (registers read, registers written) by an instruction line, or None if
+    the line isn't an instruction we understand.
+    """
+
+    op_info = OPCODES.get(line.opcode)
+
+    if line.kind != OP or op_info is None:
+        return None
+
+    op_type = op_info["type"]
+    given = (line.op_a is not None) + (line.op_b is not None)
+
+    if given != (2 if op_type == 8 else op_type):
+        # pass1 will report the wrong operand count
+        return None
+
+    operands = []
+
+    if op_type in (1, 2, 8):
+        operands.append(REGISTERS.get((line.op_a or "")[:2]))
+    if op_type == 2:
+        operands.append(REGISTERS.get((line.op_b or "")[:2]))
+
+    if None in operands:
+        # pass1 will report the bad operand
+        return None
+
+    reads = set(operands)
+    writes = set()
+
+    if line.opcode in NO_READ_A:
+        reads.discard(operands[0])
+        if line.opcode == "LD":
+            reads.add(operands[1])
+
+    if line.opcode in WRITES_A:
+        writes.add(operands[0])
+
+    if line.opcode in STACK_OPS:
+        reads.add(SP)
+        writes.add(SP)
+
+    return reads, writes
+
+
+def literal(op):
+    """The value of an LDI operand: a number, or a label name."""
+
+    try:
+        return int(op, 0)
+    except ValueError:
+        return op
+
+
+def without_statement(line):
+    """
+    What's left of a line whose instruction is removed: its label, if it
+    has one.
+    """
+
+    if line.label is None:
+        return []
+
+    return [line._replace(kind=None, opcode=None, op_a=None, op_b=None)]
+
+
+def next_statement(lines, i):
+    """Index of the first line at or after i with a statement, or None."""
+
+    while i < len(lines):
+        if lines[i].kind is not None:
+            return i
+        i += 1
+
+    return None
+
+
+def thread_jumps(lines):
+    """
+    Where "LDI Rn,L1 / JMP Rn" goes to a label whose code is just
+    "LDI Rn,L2 / JMP Rn", load L2 instead and skip the second jump.
+    Returns the number of jumps threaded.
+    """
+
+    def jump_to(i):
+        # The label loaded by "LDI Rn,label / JMP Rn" at i, and Rn
+        if i is None:
+            return None, None
+
+        ldi = lines[i]
+        j = next_statement(lines, i + 1)
+
+        if ldi.kind != OP or ldi.opcode != "LDI" or j is None:
+            return None, None
+
+        jmp = lines[j]
+        target = literal(ldi.op_b)
+
+        if jmp.kind != OP or jmp.opcode != "JMP" or jmp.op_a != ldi.op_a \
+                or not isinstance(target, str):
+            return None, None
+
+        return target, ldi.op_a
+
+    # Statement index for each label
+    labels = {}
+    for i, line in enumerate(lines):
+        if line.label is not None:
+            labels[line.label] = next_statement(lines, i)
+
+    threaded = 0
+
+    for i, line in enumerate(lines):
+        target, reg = jump_to(i)
+
+        if target is None:
+            continue
+
+        seen = {target}
+
+        while True:
+            next_target, next_reg = jump_to(labels.get(target))
+
+            if next_target is None or next_reg != reg or next_target in seen:
+                break
+
+            target = next_target
+            seen.add(target)
+
+        if target != line.op_b:
+            lines[i] = line._replace(op_b=target)
+            threaded += 1
+
+    return threaded
+
+
+def forward_pass(lines):
+    """
+    Drop LDIs of a value the register already holds, turn "ADD Rm,Rn" into
+    "INC Rm" when Rn holds 1, and drop "PUSH Rx / POP Rx" pairs. Labels and
+    data are barriers: nothing is known after them.
+    """
+
+    # Register -> value loaded by LDI, while it's still there
+    known = {}
+    result = []
+
+    for line in lines:
+        if line.label is not None:
+            # Could be reached from anywhere
+            known.clear()
+
+        regs = line_regs(line)
+
+        if regs is None:
+            if line.kind is not None:
+                known.clear()
+            result.append(line)
+            continue
+
+        opcode = line.opcode
+        # None for instructions without operands
+        reg_a = REGISTERS.get((line.op_a or "")[:2])
+
+        if opcode == "LDI":
+            value = literal(line.op_b)
+            if known.get(reg_a) == value:
+                result.extend(without_statement(line))
+                continue
+
+        elif opcode == "ADD" and known.get(REGISTERS[line.op_b[:2]]) == 1:
+            line = line._replace(opcode="INC", op_b=None)
+
+        elif opcode == "POP" and reg_a != SP and line.label is None and \
+                result and result[-1].kind == OP and \
+                result[-1].opcode == "PUSH" and result[-1].op_a == line.op_a:
+            # Leaves the register and the stack pointer as they were
+            push = result.pop()
+            result.extend(without_statement(push))
+            continue
+
+        for reg in regs[1]:
+            known.pop(reg, None)
+
+        if opcode == "LDI":
+            known[reg_a] = value
+        elif opcode in BRANCHES:
+            # A subroutine can change anything, and a branch target is a
+            # label anyway
+            known.clear()
+
+        result.append(line)
 
     return result
 
 
+def drop_dead_loads(lines):
+    """
+    Drop LDIs whose register is written again before anything reads it,
+    looking no further than the next label, branch or data.
+    """
+
+    result = []
+
+    for i, line in enumerate(lines):
+        if line.kind == OP and line.opcode == "LDI" and \
+                line_regs(line) is not None:
+            reg = REGISTERS[line.op_a[:2]]
+            dead = False
+
+            for later in lines[i + 1:]:
+                if later.label is not None:
+                    break
+                if later.kind is None:
+                    continue
+
+                regs = line_regs(later)
+                if regs is None or reg in regs[0]:
+                    break
+                if reg in regs[1]:
+                    dead = True
+                    break
+                if later.opcode in BRANCHES:
+                    break
+
+            if dead:
+                result.extend(without_statement(line))
+                continue
+
+        result.append(line)
+
+    return result
+
+
+def uses_numeric_addresses(lines):
+    """
+    True if a number loaded by LDI (or worked out from one) is used as an
+    address: as a branch target, or as the address of an LD or ST or the
+    stack pointer while it could point into the program. The code or data
+    there can't be moved, so the program can't be optimized.
+    """
+
+    # Bytes the program assembles to
+    size = sum(line_size(line) for line in lines)
+
+    # Register -> number loaded into it, or None for a value worked out
+    # from one, in source order
+    numeric = {}
+
+    def in_image(reg):
+        # Could the register hold an address inside the program?
+        if reg not in numeric:
+            return False
+        return numeric[reg] is None or numeric[reg] < size
+
+    for line in lines:
+        regs = line_regs(line)
+
+        if regs is None:
+            continue
+
+        reads, writes = regs
+        opcode = line.opcode
+        reg_a = REGISTERS.get((line.op_a or "")[:2])
+        reg_b = REGISTERS.get((line.op_b or "")[:2])
+
+        if opcode in BRANCHES and reg_a is not None and reg_a in numeric:
+            return True
+
+        if opcode == "LD" and in_image(reg_b):
+            return True
+
+        if opcode == "ST" and in_image(reg_a):
+            return True
+
+        if opcode in STACK_OPS and in_image(SP):
+            return True
+
+        for reg in writes:
+            if reg == SP and opcode in STACK_OPS:
+                # Moving the stack pointer only depends on where it was
+                if SP in numeric:
+                    numeric[SP] = None
+            elif opcode == "LDI":
+                value = literal(line.op_b)
+                if isinstance(value, int):
+                    numeric[reg] = value & 0xff
+                else:
+                    numeric.pop(reg, None)
+            elif opcode not in ("LD", "POP") and reads & numeric.keys():
+                numeric[reg] = None
+            else:
+                numeric.pop(reg, None)
+
+    return False
+
+
+def peephole(lines):
+    """
+    Optimize parsed lines. Returns the new list of lines and a dict with
+    the number of bytes saved, an estimate of the instructions (cycles)
+    saved each time the code runs through once, and whether the program
+    was skipped because it uses numeric addresses.
+    """
+
+    lines = list(lines)
+
+    if uses_numeric_addresses(lines):
+        return lines, {"bytes": 0, "cycles": 0, "skipped": True}
+
+    size_before = sum(line_size(line) for line in lines)
+    count_before = sum(1 for line in lines if line.kind == OP)
+
+    threaded = thread_jumps(lines)
+    lines = drop_dead_loads(forward_pass(lines))
+
+    count_after = sum(1 for line in lines if line.kind == OP)
+
+    return lines, {
+        "bytes": size_before - sum(line_size(line) for line in lines),
+        # A threaded jump skips an LDI and a JMP
+        "cycles": count_before - count_after + 2 * threaded,
+        "skipped": False,
+    }
+
+
+# p8() of every byte, worked out once
+P8 = ["{:08b}".format(v) for v in range(256)]
+
+
 def p8(v):
+    if 0 <= v < 256:
+        return P8[v]
     return "{:08b}".format(v)
 
 
-def pass1(inputfile, sym, code):
+def pass1(lines, sym, code):
     """
     Pass 1
 
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
+    * Take the parsed lines from parse()
     * Record label offsets
     * Emit machine code
     """
@@ -148,17 +584,16 @@ def pass1(inputfile, sym, code):
 
         nonlocal line_num
 
-        m = re.match(r"R([0-7])", op)
+        # Only the first two characters count, so R12 is R1
+        reg = REGISTERS.get(op[:2])
 
-        if m is None:
+        if reg is None:
             if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise AsmError(f"Line {line_num}: unknown register {op}", 1)
             else:
                 return None
 
-        return int(m.group(1))
+        return reg
 
     def out0(opcode, op_a, op_b, machine_code):
         """Handle opcodes with zero operands"""
@@ -201,11 +636,17 @@ def pass1(inputfile, sym, code):
 
         try:
             val_b = int(op_b, 0)
-            out_b = p8(val_b)
 
         except ValueError:
-            # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+            # If it's not a value, it might be a symbol. Keep the line
+            # number for resolve() to report.
+            out_b = f"sym:{op_b}:{line_num}"
+
+        else:
+            if val_b > 0xff:
+                raise AsmError(
+                    f"line {line_num}: value {op_b} doesn't fit in a byte")
+            out_b = p8(val_b)
 
         code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
         code.append(p8(reg_a))
@@ -213,24 +654,23 @@ def pass1(inputfile, sym, code):
 
         addr += 3
 
-    def handle_ds(line):
+    def handle_ds(data):
         """
         Handle DS pseudo-opcode
         """
 
         nonlocal addr
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
-
-        if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
-
-        data = m.group(2)
+        if data is None:
+            raise AsmError(f"line {line_num}: missing argument to DS")
 
         for i in range(len(data)):
             print_char = data[i]
 
+            if ord(print_char) > 0xff:
+                raise AsmError(f"line {line_num}: character {print_char!r} "
+                               "in DS doesn't fit in a byte")
+
             if print_char == ' ':
                 print_char = '[space]'
 
@@ -238,28 +678,21 @@ def pass1(inputfile, sym, code):
 
         addr += len(data)
 
-    def handle_db(line):
+    def handle_db(data):
         """
         Handle the DB pseudo-opcode
         """
 
         nonlocal addr
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
-
-        if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
-
-        data = m.group(2)
+        if data is None:
+            raise AsmError(f"line {line_num}: missing argument to DB")
 
         try:
             val = int(data, 0)
 
         except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+            raise AsmError(f"line {line_num}: invalid integer argument to DB")
 
         # Force to byte size
         val &= 0xff
@@ -274,18 +707,15 @@ def pass1(inputfile, sym, code):
         def check_ops_count(desired, found):
             # Makes sure we have right operand count
             if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise AsmError(f"Line {line_num}: missing operand to {opcode}",
+                               1)
             elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+                raise AsmError(
+                    f"Line {line_num}: unexpected operand to {opcode}", 1)
 
         # Make sure we know this opcode at all
         if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+            raise AsmError(f"line {line_num}: unknown opcode {opcode}")
 
         op_type = OPCODES[opcode]["type"]
 
@@ -313,90 +743,233 @@ def pass1(inputfile, sym, code):
         8: out8,
     }
 
-    for line in inputfile:
-        line_num += 1
+    for line in lines:
+        line_num = line.line_num
+        label = line.label
+        opcode = line.opcode
 
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
+        # Track label address
+        if label is not None:
+            sym[label] = addr
+            code.append(f'# {label} (address {addr}):')
 
-        # Normalize
-        line = line.strip()
+        if line.kind == OP:
+            # Check operand count
+            check_ops(opcode, line.op_a, line.op_b)
 
-        # Ignore blank lines
-        if input == '':
-            continue
+            # Handle opcodes
+            op_info = OPCODES[opcode]
+            handler = type_f[op_info["type"]]
+            handler(opcode, line.op_a, line.op_b, op_info["code"])
 
-        # print(line)  # debug
+        elif line.kind == DS:
+            handle_ds(line.data)
 
-        m = re.match(REGEX, line)
+        elif line.kind == DB:
+            handle_db(line.data)
 
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
 
-            # print(label, opcode, op_a, op_b)  # debug
+def symbol_ref(c):
+    """
+    The symbol and source line number of a "sym:" code line from pass 1.
+    """
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+    s, line_num = c[4:].strip().split(":")
 
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
-                else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
+    return s, int(line_num)
 
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
-        else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
 
+def symbol_value(sym, s, line_num):
+    """
+    The address of symbol s, for the LDI operand on line line_num. Raises
+    AsmError if it's unknown or doesn't fit in a byte.
+    """
 
-def pass2(outputfile, sym, code):
+    if s not in sym:
+        raise AsmError(f"line {line_num}: unknown symbol: {s}")
+
+    value = sym[s]
+
+    if value > 0xff:
+        raise AsmError(f"line {line_num}: symbol {s} address {value} "
+                       "doesn't fit in a byte")
+
+    return value
+
+
+def resolve(sym, code):
     """
-    Output the code, substituting in any symbols.
+    Yield the code lines, substituting in any symbols.
     """
 
     for c in code:
         # Replace symbols
         if c[:4] == 'sym:':
-            s = c[4:].strip()
+            c = p8(symbol_value(sym, *symbol_ref(c)))
 
-            if s in sym:
-                c = p8(sym[s])
+        yield c
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
 
+def pass2(outputfile, sym, code):
+    """
+    Output the code, substituting in any symbols.
+    """
+
+    for c in resolve(sym, code):
         outputfile.write(f"{c}\n")
 
 
+def to_bytes(sym, code):
+    """
+    Return the machine code as bytes, substituting in any symbols.
+    """
+
+    result = bytearray()
+
+    for c in resolve(sym, code):
+        result += code_byte(c)
+
+    return bytes(result)
+
+
+def code_byte(c):
+    """
+    The value of a machine code line as a byte string, or b"" for a label
+    comment line.
+    """
+
+    value = c.split("#")[0].strip()
+
+    if value == '':
+        return b""
+
+    return bytes([int(value, 2)])
+
+
+class Emitter:
+    """
+    Stands in for the code list in pass 1, writing each line straight to a
+    seekable output file instead of keeping them all in memory. Symbol
+    references are written as zero placeholders and their positions
+    recorded; finish() patches them once every label is known.
+    """
+
+    def __init__(self, outputfile, binary=False):
+        self.outputfile = outputfile
+        self.binary = binary
+
+        # (file position, symbol, line number) for every placeholder written
+        self.fixups = []
+
+    def append(self, c):
+        """Write one code line."""
+
+        if c[:4] == 'sym:':
+            self.fixups.append((self.outputfile.tell(), *symbol_ref(c)))
+            c = p8(0)
+
+        if self.binary:
+            self.outputfile.write(code_byte(c))
+        else:
+            self.outputfile.write(f"{c}\n")
+
+    def finish(self, sym):
+        """Patch the symbol placeholders with their addresses."""
+
+        end = self.outputfile.tell()
+
+        for position, s, line_num in self.fixups:
+            value = symbol_value(sym, s, line_num)
+
+            self.outputfile.seek(position)
+
+            if self.binary:
+                self.outputfile.write(bytes([value]))
+            else:
+                self.outputfile.write(p8(value))
+
+        self.outputfile.seek(end)
+
+
+def assemble(source, optimize=False):
+    """
+    Assemble source code (a string, or an iterable of lines) and return the
+    machine code as bytes. With optimize, the peephole optimizer runs first.
+    Raises AsmError if the source has a mistake in it.
+    """
+
+    if isinstance(source, str):
+        source = source.splitlines()
+
+    sym = {}
+    code = []
+
+    lines = parse(source)
+    if optimize:
+        lines, _ = peephole(lines)
+
+    pass1(lines, sym, code)
+
+    return to_bytes(sym, code)
+
+
 def main(argv):
+    try:
+        return assemble_files(argv)
+
+    except AsmError as e:
+        print(e, file=sys.stderr)
+        return e.status
+
+
+def assemble_files(argv):
+    """
+    Assemble the files named on the command line. Returns the exit code.
+    """
+
     # Parse command line
-    inputfile, outputfile = parse_commandline(argv)
+    inputfile, outputfile, binary, optimize = parse_commandline(argv)
 
     # Open files
-    inputfile, outputfile = open_files(inputfile, outputfile)
+    outputname = outputfile
+    inputfile, outputfile = open_files(inputfile, outputfile, binary)
+
+    lines = parse(inputfile)
+
+    if optimize:
+        lines, saved = peephole(lines)
+
+        if saved["skipped"]:
+            print("optimizer: skipped, the program uses numeric "
+                  "addresses", file=sys.stderr)
+        else:
+            print(f"optimizer: saved {saved['bytes']} bytes, about "
+                  f"{saved['cycles']} cycles per pass", file=sys.stderr)
 
     # Set up the symbol table
     sym = {}
 
-    # Set up the machine code output
+    # Only a file opened here (for writing, from the start) can be patched
+    # in place. Standard output may be a pipe, or a file opened for
+    # appending, where every write goes to the end.
+    if outputname != "-" and outputfile.seekable():
+        # Write the code out as it's assembled, then patch in the symbols
+        emitter = Emitter(outputfile, binary)
+        pass1(lines, sym, emitter)
+        emitter.finish(sym)
+
+        return 0
+
+    # Otherwise collect the machine code output first
     code = []
 
     # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    pass1(lines, sym, code)
+
+    if binary:
+        outputfile.write(to_bytes(sym, code))
+    else:
+        pass2(outputfile, sym, code)
 
     return 0
 
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# Incremental build for LS-8 assembler sources
+#
+# Usage:
+#
+#  build.py *.asm                      ; writes NAME.ls8 next to each source
+#  build.py -o ../ls8/examples *.asm   ; writes them into another directory
+#
+# Each source is hashed. The result of pass 1 (the code lines, with a
+# "sym:LABEL:LINE" placeholder wherever a label's address goes, and the
+# symbol table) is kept as an object file in __asmcache__ next to the
+# source:
+#
+# * source unchanged and output file unchanged: nothing to do
+# * source unchanged but output missing or edited: relink from the object
+#   file (pass 2 only, no parsing)
+# * source changed: assemble it again
+#
+# Sources that need assembling are handled in parallel, one per process.
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from asm import AsmError, parse, pass1, pass2
+
+# Directory (next to the sources) holding the object files
+CACHE_DIR = "__asmcache__"
+
+OBJECT_EXTENSION = ".lso"
+
+# Bump when the object file layout changes, to force a rebuild
+OBJECT_VERSION = 2
+
+# What build_one() did with a source
+UP_TO_DATE = "up to date"
+LINKED = "linked"
+ASSEMBLED = "assembled"
+FAILED = "failed"
+
+
+def digest(data):
+    """SHA-256 of some bytes, as hex."""
+
+    return hashlib.sha256(data).hexdigest()
+
+
+def object_path(source):
+    """Where the object file for a source lives."""
+
+    directory, name = os.path.split(source)
+    name = os.path.splitext(name)[0] + OBJECT_EXTENSION
+
+    return os.path.join(directory, CACHE_DIR, name)
+
+
+def output_path(source, output_dir=None):
+    """The .ls8 file built from a source."""
+
+    if output_dir is None:
+        output_dir = os.path.dirname(source)
+
+    name = os.path.splitext(os.path.basename(source))[0] + ".ls8"
+
+    return os.path.join(output_dir, name)
+
+
+def read_object(path):
+    """
+    Load an object file. Returns None if it's missing, unreadable or from a
+    different version of this script.
+    """
+
+    try:
+        with open(path) as f:
+            obj = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if obj.get("version") != OBJECT_VERSION:
+        return None
+
+    return obj
+
+
+def write_object(path, obj):
+    """Save an object file, replacing any old one in one step."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp = path + ".tmp"
+    with open(temp, "w") as f:
+        json.dump(obj, f)
+    os.replace(temp, path)
+
+
+def compile_source(text):
+    """
+    Run pass 1 over source text and return the object: the code lines and
+    the symbol table.
+    """
+
+    sym = {}
+    code = []
+
+    pass1(parse(io.StringIO(text)), sym, code)
+
+    return {
+        "version": OBJECT_VERSION,
+        "code": code,
+        "sym": sym,
+    }
+
+
+def link(obj):
+    """Run pass 2 over an object and return the .ls8 text."""
+
+    out = io.StringIO()
+    pass2(out, obj["sym"], obj["code"])
+
+    return out.getvalue()
+
+
+def build_one(job):
+    """
+    Bring the output of one source up to date. job is a tuple of
+    (source, output, force). Returns (source, what was done).
+    """
+
+    source, output, force = job
+
+    with open(source, "rb") as f:
+        source_hash = digest(f.read())
+
+    obj_file = object_path(source)
+    obj = None if force else read_object(obj_file)
+
+    if obj is not None and obj.get("source_hash") == source_hash:
+        # Source unchanged; is the output too?
+        try:
+            with open(output, "rb") as f:
+                if digest(f.read()) == obj.get("output_hash"):
+                    return source, UP_TO_DATE
+        except OSError:
+            pass
+
+        action = LINKED
+
+    else:
+        with open(source) as f:
+            text = f.read()
+
+        try:
+            obj = compile_source(text)
+        except AsmError as e:
+            print(f"{source}: {e}", file=sys.stderr)
+            return source, FAILED
+
+        obj["source_hash"] = source_hash
+        action = ASSEMBLED
+
+    try:
+        text = link(obj)
+    except AsmError as e:
+        print(f"{source}: {e}", file=sys.stderr)
+        return source, FAILED
+
+    with open(output, "w") as f:
+        f.write(text)
+
+    obj["output_hash"] = digest(text.encode())
+    write_object(obj_file, obj)
+
+    return source, action
+
+
+def build(sources, output_dir=None, workers=None, force=False):
+    """
+    Build every source, in parallel. Yields (source, what was done) in the
+    order given.
+    """
+
+    jobs = [(s, output_path(s, output_dir), force) for s in sources]
+
+    if len(jobs) == 1:
+        # Not worth starting a process for
+        yield build_one(jobs[0])
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(build_one, jobs):
+            yield result
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        description="Assemble only the LS-8 sources that changed.")
+    parser.add_argument("sources", nargs="+",
+                        help=".asm files to build")
+    parser.add_argument("-o", "--output-dir",
+                        help="directory for the .ls8 files "
+                        "(default: next to each source)")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument("-f", "--force", action="store_true",
+                        help="assemble everything, ignoring the cache")
+
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    counts = {UP_TO_DATE: 0, LINKED: 0, ASSEMBLED: 0, FAILED: 0}
+
+    for source, action in build(args.sources, args.output_dir, args.jobs,
+                                args.force):
+        counts[action] += 1
+
+        if action != UP_TO_DATE:
+            print(f"{action}: {source}")
+
+    print(", ".join(f"{count} {action}" for action, count in counts.items()))
+
+    return 1 if counts[FAILED] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
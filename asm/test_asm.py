@@ -0,0 +1,89 @@
+"""
+Regression tests for the assembler. Run from this directory with
+
+    python -m unittest test_asm
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from asm import AsmError, assemble, main
+
+
+def run_main(source, to_stdout):
+    """
+    Run asm.py on source, to a named output file or to stdout. Returns the
+    exit status and what was printed to stderr.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        inputname = os.path.join(directory, "in.asm")
+        with open(inputname, "w") as f:
+            f.write(source)
+
+        argv = ["asm.py", inputname]
+        if not to_stdout:
+            argv.append(os.path.join(directory, "out.ls8"))
+
+        errors = io.StringIO()
+        with contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(errors):
+            status = main(argv)
+
+    return status, errors.getvalue()
+
+
+# A label past the end of what an LDI operand can hold
+LABEL_TOO_HIGH = "LDI R0,End\nJMP R0\n" + "LDI R1,1\nPRN R1\n" * 90 + \
+    "End:\nHLT\n"
+
+
+class OptimizerTest(unittest.TestCase):
+
+    def test_data_read_through_numeric_address_is_left_alone(self):
+        # Dropping the second LDI would move the DB byte the LD reads
+        # through its hard-coded address
+        for address in (12, 15):
+            source = (f"LDI R2,5\nLDI R2,5\nLDI R0,{address}\nLD R1,R0\n"
+                      "PRN R1\nHLT\nDB 42\n")
+            self.assertEqual(assemble(source, optimize=True),
+                             assemble(source))
+
+    def test_labels_are_still_optimized(self):
+        source = "LDI R2,5\nLDI R2,5\nLDI R0,Data\nLD R1,R0\nPRN R1\nHLT\n" \
+                 "Data:\nDB 42\n"
+        program = assemble(source, optimize=True)
+        self.assertEqual(len(program), len(assemble(source)) - 3)
+        self.assertEqual(program[program[5]], 42)
+
+
+class RangeTest(unittest.TestCase):
+
+    def test_label_too_high(self):
+        with self.assertRaisesRegex(AsmError, "^line 1: symbol END address"):
+            assemble(LABEL_TOO_HIGH)
+
+    def test_label_after_long_string(self):
+        source = "LDI R0,End\nDS " + "x" * 300 + "\nEnd:\nHLT\n"
+        with self.assertRaisesRegex(AsmError, "^line 1: "):
+            assemble(source)
+
+    def test_string_character_too_high(self):
+        with self.assertRaisesRegex(AsmError, "^line 2: "):
+            assemble("HLT\nDS caf\u00e9\u20ac\n")
+
+    def test_number_too_high(self):
+        with self.assertRaisesRegex(AsmError, "^line 1: value 300"):
+            assemble("LDI R0,300\nHLT\n")
+
+    def test_label_too_high_fails_the_same_in_both_output_modes(self):
+        for to_stdout in (False, True):
+            status, errors = run_main(LABEL_TOO_HIGH, to_stdout)
+            self.assertEqual(status, 2)
+            self.assertIn("doesn't fit in a byte", errors)
+
+
+if __name__ == "__main__":
+    unittest.main()
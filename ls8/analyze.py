@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+"""
+Static analysis of LS-8 programs.
+
+Decodes the program in RAM into instructions without running it, following
+the control flow from address 0 and from every interrupt handler the
+program installs in the vector table. Jumps and CALLs go through registers,
+so each register's value is tracked while it is a known constant (set by
+LDI, or by arithmetic on known values). That recovers the targets of the
+usual `LDI R2,Label` / `JMP R2` pattern:
+
+    cpu = CPU()
+    cpu.load('examples/call.ls8')
+    analysis = analyze(cpu)
+    analysis.blocks          # start address -> Block
+    analysis.calls           # addresses that are CALLed
+    analysis.handlers        # interrupt handlers installed with ST
+    analysis.loops           # (head, latch) block starts for each back edge
+    analysis.unreached       # (start, end) ranges of bytes never executed
+    analysis.unimplemented   # (address, problem) for each instruction
+                             # run() would stop with an error at
+    analysis.unresolved      # addresses of jumps whose target is unknown
+
+While analysis.unresolved is empty the control flow found is complete;
+otherwise some code may be reported as unreached when it isn't.
+
+warm() uses the analysis to decode (and with the JIT, compile) every basic
+block before the program starts, instead of as the PC first reaches it.
+
+From the command line:
+
+    python3 analyze.py examples/call.ls8 [--listing]
+"""
+
+import argparse
+import sys
+from collections import deque, namedtuple
+
+from cpu import *
+from image import ASM_DIRECTORY, load_program
+from jit import BLOCK_ENDS
+
+if ASM_DIRECTORY not in sys.path:
+    sys.path.insert(0, ASM_DIRECTORY)
+from asm import OPCODES
+
+# Mnemonic for each opcode the assembler knows, including the ones the
+# emulator doesn't implement (INT, NOP)
+NAMES = {int(info["code"], 2): name for name, info in OPCODES.items()}
+
+# Where the interrupt vectors are
+VECTOR_TABLE = 0xF8
+
+# Registers with a special job
+IS = 6
+SP = 7
+
+CONDITIONAL_JUMPS = {JEQ, JNE, JGT, JLT, JLE, JGE}
+
+# New value of register a from the known values of registers a and b
+BINARY = {
+    ADD: lambda x, y: (x + y) & 0xFF,
+    SUB: lambda x, y: (x - y) & 0xFF,
+    MUL: lambda x, y: (x * y) & 0xFF,
+    DIV: lambda x, y: x // y if y else None,
+    MOD: lambda x, y: x % y if y else None,
+    AND: lambda x, y: x & y,
+    OR: lambda x, y: x | y,
+    XOR: lambda x, y: x ^ y,
+    SHR: lambda x, y: x >> y,
+    SHL: lambda x, y: (x << y) & 0xFF,
+}
+
+# Likewise from the known value of register a alone
+UNARY = {
+    INC: lambda x: (x + 1) & 0xFF,
+    DEC: lambda x: (x - 1) & 0xFF,
+    NOT: lambda x: ~x & 0xFF,
+}
+
+# Register values at reset: all zero, except the SP. IS is never known,
+# since interrupts set its bits between any two instructions.
+RESET_STATE = (0, 0, 0, 0, 0, 0, None, 0xF4)
+
+# Nothing is known on entry to an interrupt handler
+UNKNOWN_STATE = (None,) * 8
+
+# One decoded instruction. operands are the operand bytes.
+Instruction = namedtuple('Instruction',
+                         ['address', 'ir', 'name', 'operands', 'size'])
+
+# A basic block: its start address, the address just past it, its
+# instructions, and the start addresses of the blocks that can follow it
+Block = namedtuple('Block', ['start', 'end', 'instructions', 'successors'])
+
+
+class Analysis:
+    """What analyze() found out about a program."""
+
+    def __init__(self, length):
+        # How many bytes of RAM hold the program
+        self.length = length
+
+        # address -> Instruction, for every instruction that can run
+        self.instructions = {}
+        # address -> set of addresses that can run next
+        self.successors = {}
+        # start address -> Block
+        self.blocks = {}
+
+        self.entries = {0}
+        self.calls = set()
+        self.handlers = set()
+        self.loops = []
+        self.unreached = []
+        self.unimplemented = []
+        self.unresolved = set()
+
+    @property
+    def code_size(self):
+        """Bytes of the program that are instructions which can run."""
+        return sum(i.size for i in self.instructions.values())
+
+    def report(self, file=None, listing=False):
+        """Print a summary, and with listing the disassembled blocks."""
+        if file is None:
+            file = sys.stdout
+
+        print(f"Program: {self.length} bytes, {self.code_size} bytes of "
+              f"reachable code, {self.length - self.code_size} other",
+              file=file)
+        print(f"Basic blocks: {len(self.blocks)}", file=file)
+        print(f"Calls: {hex_list(self.calls)}", file=file)
+        print(f"Interrupt handlers: {hex_list(self.handlers)}", file=file)
+        print("Loops: " + (", ".join(f"{head:02X} (from {latch:02X})"
+                                     for head, latch in self.loops)
+                           or "none"), file=file)
+
+        if self.unreached:
+            print("Unreached bytes (data, or dead code): " +
+                  ", ".join(f"{start:02X}-{end - 1:02X}"
+                            for start, end in self.unreached), file=file)
+        for address, problem in self.unimplemented:
+            print(f"Can't run {address:02X}: {problem}", file=file)
+        for address in sorted(self.unresolved):
+            print(f"Unknown jump target at {address:02X}; the analysis may "
+                  "be incomplete", file=file)
+
+        if listing:
+            for start in sorted(self.blocks):
+                block = self.blocks[start]
+                print(f"\n{start:02X}:", file=file)
+                for instruction in block.instructions:
+                    print(f"  {instruction.address:02X}  "
+                          f"{disassemble(instruction)}", file=file)
+                print(f"  -> {hex_list(block.successors)}", file=file)
+
+
+def decode(ram, pc, ops):
+    """
+    Decode the instruction at pc. Returns (Instruction, problem), where
+    problem says why CPU.decode() would refuse it, or is None.
+    """
+    if pc >= len(ram):
+        # The instruction before ran right up to the end of RAM
+        return Instruction(pc, None, "fetch", (), 0), \
+            "past the end of RAM"
+
+    ir = ram[pc]
+    num_operands = (ir & 0b11000000) >> 6
+    size = 1 + num_operands
+    name = NAMES.get(ir, f"{ir:02X}")
+
+    if pc + size > len(ram):
+        instruction = Instruction(pc, ir, name, (), 1)
+        return instruction, "past the end of RAM"
+
+    operands = tuple(ram[pc + 1:pc + size])
+    instruction = Instruction(pc, ir, name, operands, size)
+
+    if ir not in ops:
+        return instruction, "not implemented"
+
+    registers = operands[:1] if ir in (LDI, ADDI) else operands
+    if any(register > 7 for register in registers):
+        return instruction, "invalid register"
+
+    return instruction, None
+
+
+def disassemble(instruction):
+    """Assembler text for an instruction, e.g. "LDI R0,0x12"."""
+    ir = instruction.ir
+    operands = [f"R{o}" for o in instruction.operands]
+    if ir in (LDI, ADDI) and len(operands) == 2:
+        operands[1] = f"0x{instruction.operands[1]:02X}"
+    return (instruction.name + " " + ",".join(operands)).strip()
+
+
+def analyze(cpu, length=None):
+    """
+    Analyze the program in the CPU's RAM (which isn't changed). length is
+    how many bytes it takes up; by default, up to the last non-zero byte.
+    """
+    ram = bytes(cpu.ram)
+    if length is None:
+        length = len(ram.rstrip(b"\0"))
+
+    analysis = Analysis(length)
+    instructions = analysis.instructions
+    successors = analysis.successors
+
+    # Known register values on arrival at each address that can run
+    states = {}
+    work = deque()
+
+    def flow(source, address, state):
+        # state can reach address from source: merge it in
+        if source is not None:
+            successors[source].add(address)
+        state = state[:IS] + (None,) + state[IS + 1:]
+        old = states.get(address)
+        if old is None:
+            new = state
+        else:
+            new = tuple(a if a == b else None for a, b in zip(old, state))
+        if new != old:
+            states[address] = new
+            work.append(address)
+
+    # RET can return to the instruction after any CALL, with whatever is
+    # known at any RET
+    return_sites = set()
+    return_state = None
+
+    flow(None, 0, RESET_STATE)
+
+    while work:
+        pc = work.popleft()
+        state = states[pc]
+
+        instruction, problem = decode(ram, pc, cpu.ops)
+        if problem is not None:
+            analysis.unimplemented.append(
+                (pc, f"{instruction.name} ({problem})"))
+            continue
+
+        instructions[pc] = instruction
+        successors.setdefault(pc, set())
+
+        ir = instruction.ir
+        a = instruction.operands[0] if instruction.operands else None
+        b = instruction.operands[1] if len(instruction.operands) > 1 else None
+        next_pc = pc + instruction.size
+        after = list(state)
+
+        if ir == HLT or ir == IRET:
+            continue
+
+        if ir == JMP or ir in CONDITIONAL_JUMPS or ir == CALL:
+            target = state[a]
+            if ir == CALL:
+                after[SP] = None if after[SP] is None else (after[SP] - 1) & 0xFF
+            if target is None:
+                analysis.unresolved.add(pc)
+            else:
+                if ir == CALL:
+                    analysis.calls.add(target)
+                flow(pc, target, tuple(after))
+
+            if ir in CONDITIONAL_JUMPS:
+                flow(pc, next_pc, state)
+            elif ir == CALL and next_pc not in return_sites:
+                return_sites.add(next_pc)
+                successors[pc].add(next_pc)
+                if return_state is not None:
+                    flow(None, next_pc, return_state)
+            continue
+
+        if ir == RET:
+            after[SP] = None if after[SP] is None else (after[SP] + 1) & 0xFF
+            after = tuple(after)
+            if return_state is None:
+                return_state = after
+            else:
+                return_state = tuple(x if x == y else None
+                                     for x, y in zip(return_state, after))
+            for site in return_sites:
+                flow(pc, site, return_state)
+            continue
+
+        # Everything else carries on to the next instruction
+        if ir == LDI:
+            after[a] = b
+        elif ir == ADDI:
+            after[a] = None if state[a] is None else (state[a] + b) & 0xFF
+        elif ir in BINARY:
+            if state[a] is None or state[b] is None:
+                after[a] = None
+            else:
+                after[a] = BINARY[ir](state[a], state[b])
+        elif ir in UNARY:
+            after[a] = None if state[a] is None else UNARY[ir](state[a])
+        elif ir == LD:
+            after[a] = None
+        elif ir == PUSH:
+            after[SP] = None if state[SP] is None else (state[SP] - 1) & 0xFF
+        elif ir == POP:
+            after[SP] = None if state[SP] is None else (state[SP] + 1) & 0xFF
+            after[a] = None
+        elif ir == ST:
+            # Storing a known address in the vector table installs a handler
+            address, value = state[a], state[b]
+            if address is None or address >= VECTOR_TABLE:
+                if value is None:
+                    # Maybe a handler, but we can't tell where
+                    analysis.unresolved.add(pc)
+                elif address is not None and value not in analysis.handlers:
+                    analysis.handlers.add(value)
+                    analysis.entries.add(value)
+                    flow(None, value, UNKNOWN_STATE)
+
+        flow(pc, next_pc, tuple(after))
+
+    analysis.unimplemented.sort()
+    find_blocks(analysis)
+    find_loops(analysis)
+    find_unreached(analysis, ram)
+
+    return analysis
+
+
+def find_blocks(analysis):
+    # Split the instructions into basic blocks
+    instructions = analysis.instructions
+    successors = analysis.successors
+
+    predecessors = {address: [] for address in instructions}
+    for source, targets in successors.items():
+        for target in targets:
+            if target in predecessors:
+                predecessors[target].append(source)
+
+    def falls_into(address):
+        # Whether the instruction at address only ever follows the one
+        # before it, so they belong in the same block
+        sources = predecessors[address]
+        if address in analysis.entries or len(sources) != 1:
+            return False
+        source = instructions[sources[0]]
+        return (source.address + source.size == address and
+                source.ir not in BLOCK_ENDS and
+                successors[source.address] == {address})
+
+    for start in sorted(instructions):
+        if falls_into(start):
+            continue
+
+        block = []
+        address = start
+        while True:
+            instruction = instructions[address]
+            block.append(instruction)
+            following = instruction.address + instruction.size
+            if following not in instructions or not falls_into(following):
+                break
+            address = following
+
+        last = block[-1]
+        analysis.blocks[start] = Block(
+            start, last.address + last.size, block,
+            sorted(successors[last.address]))
+
+
+def find_loops(analysis):
+    # A loop is a jump back to a block that is still being explored in a
+    # depth-first walk. Each subroutine and handler is walked on its own,
+    # with a CALL going straight on to its return address, so returns to
+    # other call sites don't look like loops.
+    blocks = analysis.blocks
+
+    def local_successors(block):
+        last = block.instructions[-1]
+        if last.ir == CALL:
+            return [last.address + last.size]
+        if last.ir == RET:
+            return []
+        return block.successors
+
+    visited = set()
+    on_stack = set()
+
+    for entry in sorted(analysis.entries | analysis.calls):
+        if entry not in blocks or entry in visited:
+            continue
+        visited.add(entry)
+        on_stack.add(entry)
+        stack = [(entry, iter(local_successors(blocks[entry])))]
+
+        while stack:
+            start, following = stack[-1]
+            for successor in following:
+                if successor in on_stack:
+                    analysis.loops.append((successor, start))
+                elif successor not in visited and successor in blocks:
+                    visited.add(successor)
+                    on_stack.add(successor)
+                    stack.append(
+                        (successor, iter(local_successors(blocks[successor]))))
+                    break
+            else:
+                stack.pop()
+                on_stack.discard(start)
+
+    analysis.loops.sort()
+
+
+def find_unreached(analysis, ram):
+    # Ranges of program bytes no reachable instruction covers
+    covered = bytearray(len(ram))
+    for instruction in analysis.instructions.values():
+        covered[instruction.address:instruction.address + instruction.size] = \
+            b"\1" * instruction.size
+    for address, _ in analysis.unimplemented:
+        if address < len(ram):
+            covered[address] = 1
+
+    start = None
+    for address in range(analysis.length + 1):
+        if address < analysis.length and not covered[address]:
+            if start is None:
+                start = address
+        elif start is not None:
+            analysis.unreached.append((start, address))
+            start = None
+
+
+def warm(cpu, jit=False):
+    """
+    Decode every instruction the program can reach, and with jit compile
+    each basic block, so run() and run_jit() start with them ready.
+    Returns the Analysis.
+    """
+    analysis = analyze(cpu)
+
+    for address in analysis.instructions:
+        if cpu.decoded[address] is None:
+            cpu.decode(address)
+
+    if jit:
+        from jit import BlockCompiler
+        if cpu.jit is None:
+            cpu.jit = BlockCompiler(cpu)
+        cpu.jit.precompile(analysis.blocks)
+
+    return analysis
+
+
+def hex_list(addresses):
+    return ", ".join(f"{a:02X}" for a in sorted(addresses)) or "none"
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        description="Find the control flow of an LS-8 program without "
+        "running it.")
+    parser.add_argument('program',
+                        help=".ls8, .ls8b, .asm or .bin file to analyze")
+    parser.add_argument('--listing', action='store_true',
+                        help="also print each basic block")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    try:
+        program = load_program(args.program)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    cpu = CPU()
+    cpu.load_bytes(program)
+
+    analysis = analyze(cpu, len(program))
+    analysis.report(listing=args.listing)
+
+    # Fail when the program can run into something the emulator rejects
+    return 1 if analysis.unimplemented else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
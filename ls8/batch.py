@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Run many LS-8 programs at once, each on its own CPU, spread over a pool of
+worker processes. Results are written as JSON lines.
+
+Usage:
+
+    batch.py examples/                    # every program file in a directory
+    batch.py a.ls8 b.ls8b                 # specific programs
+    batch.py --manifest jobs.jsonl        # one JSON job per line
+
+A manifest line looks like:
+
+    {"program": "examples/mult.ls8", "max_cycles": 100000, "timeout": 2}
+
+Relative program paths in a manifest are relative to the manifest file.
+max_cycles and timeout are optional and default to the command line values.
+"clock_hz" runs the timer on a virtual clock (see CPU), which makes timer
+interrupts reproducible. "input" is optional text typed on the keyboard (see
+keyboard.py):
+
+    {"program": "examples/keyboard.ls8", "max_cycles": 10000, "input": "hi"}
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from cpu import *
+from image import ASM_EXTENSION, IMAGE_EXTENSION, RAW_EXTENSION
+from keyboard import KeyboardInput
+from output import MemorySink
+
+# Extra reason reported when a program runs out of wall-clock time
+TIMEOUT = 'timeout'
+
+# Instructions to run between checks of the wall-clock timeout
+SLICE_CYCLES = 100000
+
+# Default wall-clock limit per program, in seconds
+DEFAULT_TIMEOUT = 10.0
+
+PROGRAM_EXTENSIONS = ('.ls8', IMAGE_EXTENSION, ASM_EXTENSION, RAW_EXTENSION)
+
+
+def run_job(job):
+    """
+    Run one job (a dict with "program" and optionally "max_cycles",
+    "timeout", "jit", "clock_hz" and "input") and return its result as a
+    dict.
+    """
+    program = job["program"]
+    max_cycles = job.get("max_cycles")
+    timeout = job.get("timeout")
+
+    started = time.monotonic()
+
+    try:
+        # ValueError for a manifest's clock_hz below 1
+        cpu = CPU(output=MemorySink(), clock_hz=job.get("clock_hz"))
+        cpu.load(program)
+    except (CPUError, OSError, ValueError) as e:
+        result = RunResult(ERROR, 0, '', str(e))
+    else:
+        if job.get("input") is not None:
+            KeyboardInput(cpu, job["input"])
+
+        run = cpu.run_jit if job.get("jit") else cpu.run
+        result = run_slices(cpu, run, max_cycles, timeout, started)
+
+    return {
+        "program": program,
+        "reason": result.reason,
+        "cycles": result.cycles,
+        "output": result.output,
+        "error": result.error,
+        "seconds": round(time.monotonic() - started, 6),
+    }
+
+
+def run_slices(cpu, run, max_cycles, timeout, started):
+    # Run in slices so the timeout can be checked in between
+    while True:
+        slice_cycles = SLICE_CYCLES
+        if max_cycles is not None:
+            slice_cycles = min(slice_cycles, max_cycles - cpu.cycles)
+
+        result = run(slice_cycles)
+
+        if result.reason != MAX_CYCLES:
+            return result
+        if max_cycles is not None and cpu.cycles >= max_cycles:
+            return result
+        if timeout is not None and time.monotonic() - started > timeout:
+            return result._replace(reason=TIMEOUT)
+
+
+def find_programs(path):
+    """The program files in a directory, or the path itself for a file."""
+    if not os.path.isdir(path):
+        return [path]
+
+    return sorted(
+        os.path.join(path, name)
+        for name in os.listdir(path)
+        if name.endswith(PROGRAM_EXTENSIONS)
+    )
+
+
+def read_manifest(path):
+    """Load the jobs listed in a JSON lines manifest."""
+    base = os.path.dirname(path)
+    jobs = []
+
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line == '':
+                continue
+            job = json.loads(line)
+            job["program"] = os.path.join(base, job["program"])
+            jobs.append(job)
+
+    return jobs
+
+
+def run_batch(jobs, workers=None, max_cycles=None, timeout=DEFAULT_TIMEOUT,
+              jit=False, clock_hz=None):
+    """
+    Run jobs (dicts as taken by run_job, or program paths) across a pool of
+    processes. Yields one result dict per job, in the order given.
+    """
+    prepared = []
+    for job in jobs:
+        if isinstance(job, str):
+            job = {"program": job}
+        job = dict(job)
+        job.setdefault("max_cycles", max_cycles)
+        job.setdefault("timeout", timeout)
+        job.setdefault("jit", jit)
+        job.setdefault("clock_hz", clock_hz)
+        prepared.append(job)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(run_job, prepared):
+            yield result
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        description="Run many LS-8 programs in parallel.")
+    parser.add_argument('paths', nargs='*',
+                        help="program files or directories of programs")
+    parser.add_argument('--manifest',
+                        help="JSON lines file listing the jobs to run")
+    parser.add_argument('-j', '--jobs', type=int,
+                        help="number of worker processes (default: CPU count)")
+    parser.add_argument('--max-cycles', type=int,
+                        help="instruction limit per program")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help="wall-clock limit per program, in seconds")
+    parser.add_argument('--jit', action='store_true',
+                        help="use the basic-block compiler")
+    parser.add_argument('--clock-hz', type=clock_rate, metavar='N',
+                        help="run timer interrupts on a virtual clock of N "
+                        "instructions per second")
+    parser.add_argument('-o', '--output',
+                        help="write results here instead of stdout")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    jobs = []
+    if args.manifest is not None:
+        jobs.extend(read_manifest(args.manifest))
+    for path in args.paths:
+        jobs.extend(find_programs(path))
+
+    if not jobs:
+        print("batch.py: no programs given", file=sys.stderr)
+        return 1
+
+    if args.output is None:
+        outputfile = sys.stdout
+    else:
+        outputfile = open(args.output, "w")
+
+    try:
+        results = run_batch(jobs, args.jobs, args.max_cycles, args.timeout,
+                            args.jit, args.clock_hz)
+        for result in results:
+            outputfile.write(json.dumps(result) + "\n")
+    finally:
+        if outputfile is not sys.stdout:
+            outputfile.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Benchmark the emulator on a fixed set of workloads.
+
+Each workload is run through CPU.run() (and CPU.run_jit() with --jit) and the
+best wall time of a few repeats is reported, along with the instruction count,
+instructions per second and peak Python memory use. Results can be written to
+a JSON file and compared against an earlier run to spot regressions:
+
+    bench.py --output before.json
+    ... change things ...
+    bench.py --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from cpu import *
+from image import load_program
+from output import NullSink
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'examples')
+
+# Example programs that halt on their own
+EXAMPLE_WORKLOADS = [
+    'histogram_loop.ls8',
+    'print_asteriks_loop.ls8',
+    'printstr.ls8',
+    'call.ls8',
+    'sctest.ls8',
+    'stack.ls8',
+]
+
+# The inner loop of long_loop() runs 256 * 256 times per outer iteration
+INNER_ITERATIONS = 256 * 256
+
+DEFAULT_ITERATIONS = 10000000
+
+
+def long_loop(iterations):
+    """
+    A program that runs an INC/CMP/JNE loop about `iterations` times, using
+    three nested byte-sized counters. Returns (program, actual_iterations).
+    """
+    outer = max(1, min(255, round(iterations / INNER_ITERATIONS)))
+
+    program = bytes([
+        LDI, 3, 0,          # 0:  R3 = 0, the value the counters wrap to
+        LDI, 4, 6,          # 3:  R4 = address of the inner loop
+        INC, 0,             # 6:  inner: R0 += 1
+        CMP, 0, 3,          # 8:  R0 == 0?
+        JNE, 4,             # 11: no: back to inner
+        INC, 1,             # 13: R1 += 1
+        CMP, 1, 3,          # 15: R1 == 0?
+        JNE, 4,             # 18: no: back to inner
+        INC, 2,             # 20: R2 += 1
+        LDI, 3, outer,      # 22:
+        CMP, 2, 3,          # 25: R2 == outer?
+        LDI, 3, 0,          # 28: (LDI leaves the flags alone)
+        JNE, 4,             # 31: no: back to inner
+        HLT,                # 33
+    ])
+
+    return program, outer * INNER_ITERATIONS
+
+
+def call_loop():
+    """
+    A program that CALLs a subroutine which PUSHes, POPs and RETurns,
+    256 * 256 times.
+    """
+    return bytes([
+        LDI, 3, 0,          # 0:  R3 = 0, the value the counters wrap to
+        LDI, 4, 9,          # 3:  R4 = address of the loop
+        LDI, 2, 0,          # 6:  R2 = 0
+        LDI, 0, 29,         # 9:  loop: R0 = address of the subroutine
+        CALL, 0,            # 12:
+        INC, 1,             # 14: R1 += 1
+        CMP, 1, 3,          # 16: R1 == 0?
+        JNE, 4,             # 19: no: loop
+        INC, 2,             # 21: R2 += 1
+        CMP, 2, 3,          # 23: R2 == 0?
+        JNE, 4,             # 26: no: loop
+        HLT,                # 28
+        PUSH, 1,            # 29: subroutine
+        POP, 0,             # 31:
+        RET,                # 33:
+    ])
+
+
+def workloads(iterations):
+    """(name, program bytes) for every workload."""
+    loads = []
+
+    for name in EXAMPLE_WORKLOADS:
+        program = load_program(os.path.join(EXAMPLES, name))
+        loads.append((name, program))
+
+    program, actual = long_loop(iterations)
+    loads.append((f'long_loop_{actual}', program))
+    loads.append(('call_loop', call_loop()))
+
+    return loads
+
+
+def run_once(program, engine):
+    # One run on a fresh CPU; returns (seconds, RunResult)
+    cpu = CPU(output=NullSink())
+    cpu.load(program)
+    run = cpu.run_jit if engine == 'jit' else cpu.run
+
+    started = time.perf_counter()
+    result = run()
+    return time.perf_counter() - started, result
+
+
+def measure(name, program, engine, repeats):
+    """Benchmark one workload on one engine and return a result dict."""
+    best = None
+    for _ in range(repeats):
+        seconds, result = run_once(program, engine)
+        if best is None or seconds < best:
+            best = seconds
+
+    # Memory is measured in a separate run, since tracing slows things down
+    tracemalloc.start()
+    run_once(program, engine)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'workload': name,
+        'engine': engine,
+        'reason': result.reason,
+        'instructions': result.cycles,
+        'seconds': round(best, 6),
+        'instructions_per_second': round(result.cycles / best) if best else 0,
+        'peak_memory_bytes': peak,
+    }
+
+
+def current_commit():
+    # The git commit being benchmarked, if there is one
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """Print the speed of each result relative to an earlier run."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    before = {(r['workload'], r['engine']): r for r in baseline['results']}
+
+    print()
+    print(f"Compared with {baseline_path} ({baseline.get('commit')}):")
+    for r in results:
+        old = before.get((r['workload'], r['engine']))
+        if old is None or not old['instructions_per_second']:
+            continue
+        ratio = r['instructions_per_second'] / old['instructions_per_second']
+        print(f"  {r['workload']:<28} {r['engine']:<6} {ratio:6.2f}x")
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the LS-8 emulator.")
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS,
+                        help="iterations of the long loop workload "
+                        "(rounded to a multiple of 65536)")
+    parser.add_argument('--repeats', type=int, default=3,
+                        help="runs per workload; the fastest is reported")
+    parser.add_argument('--jit', action='store_true',
+                        help="also benchmark the basic-block compiler")
+    parser.add_argument('-o', '--output',
+                        help="write the results to this JSON file")
+    parser.add_argument('--compare',
+                        help="JSON file from an earlier run to compare with")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    engines = ['interp']
+    if args.jit:
+        engines.append('jit')
+
+    results = []
+    print(f"{'workload':<28} {'engine':<6} {'instructions':>12} "
+          f"{'seconds':>9} {'MIPS':>7} {'peak KiB':>9}")
+
+    for name, program in workloads(args.iterations):
+        for engine in engines:
+            r = measure(name, program, engine, args.repeats)
+            results.append(r)
+            print(f"{name:<28} {engine:<6} {r['instructions']:>12} "
+                  f"{r['seconds']:>9.4f} "
+                  f"{r['instructions_per_second'] / 1e6:>7.2f} "
+                  f"{r['peak_memory_bytes'] / 1024:>9.1f}")
+
+    report = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
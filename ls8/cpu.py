@@ -1,7 +1,9 @@
 """CPU functionality."""
-import os
-import sys
 import time
+from collections import namedtuple
+
+from image import load_program
+from output import MemorySink, make_sink
 
 LDI = 0b10000010
 LD = 0b10000011
@@ -42,18 +44,88 @@ CMP = 0b10100111
 
 ADDI = 0b10101111
 
+# The FL bits each conditional jump jumps on, when FL was just set by CMP
+# (which sets exactly one of L, G and E)
+JUMP_FLAGS = {
+    JEQ: 0b001,
+    JNE: 0b110,
+    JLT: 0b100,
+    JLE: 0b101,
+    JGT: 0b010,
+    JGE: 0b011,
+}
+
+# What CPU.invalidate() puts in the decode caches, enough for the longest
+# fused pair
+CLEARED = (None,) * 5
+
+# Entries in each decode cache: one per RAM address, plus one for a PC that
+# has run off the end of RAM (256), which then fails to decode with a
+# CPUError like any other bad fetch
+CACHE_SIZE = 257
+
+# How many instructions run() executes between checks of the timer
+TIMER_POLL_INTERVAL = 1000
+
+# Reasons run() can return
+HALTED = 'halted'
+MAX_CYCLES = 'max_cycles'
+ERROR = 'error'
+
+# What run() returns: why it stopped, the total instruction count, the text
+# printed so far (when the output is captured) and the error message, if any
+RunResult = namedtuple('RunResult', ['reason', 'cycles', 'output', 'error'])
+
+# An immutable copy of the whole machine state, from CPU.snapshot().
+# reg and ram are bytes; timer_elapsed is how far the timer interrupt's
+# second had run (in seconds, or in cycles with a virtual clock); output is
+# the captured text (None unless the output is kept in memory); clock_hz is
+# the virtual clock rate, or None.
+Snapshot = namedtuple('Snapshot', [
+    'reg', 'ram', 'pc', 'fl', 'cycles', 'interrupts_enabled',
+    'timer_elapsed', 'output', 'clock_hz',
+])
+
+
+class CPUError(Exception):
+    """Raised for anything the emulated program can't continue after."""
+
+
+class Halt(Exception):
+    """Raised by HLT to stop run()."""
+
 
 class CPU:
     """Main CPU class."""
 
-    def __init__(self):
-        """Construct a new CPU."""
-        self.reg = [0] * 8
+    def __init__(self, output=None, clock_hz=None):
+        """
+        Construct a new CPU. PRN and PRA write to output, an output.Sink or
+        a file object, which defaults to buffered stdout. Pass a MemorySink
+        (or an io.StringIO) to capture what the program prints.
+
+        The timer interrupt fires once a second of wall-clock time. With
+        clock_hz, it runs on a virtual clock instead: a second is clock_hz
+        instructions, so timer-driven programs run at full speed and fire
+        at the same instructions every time. Raises ValueError if clock_hz
+        is less than 1.
+        """
+        if clock_hz is not None and clock_hz <= 0:
+            raise ValueError("clock_hz must be at least 1, not " +
+                             str(clock_hz))
+
+        self.output = make_sink(output)
+
+        # Registers and RAM are bytearrays, so every value is a single byte.
+        # Anything that could leave 0-255 is masked with 0xFF before storing.
+        self.reg = bytearray(8)
         # sets SP (stack pointer) to the value F4
         self.sp = -1  # AKA 7
         self.reg[self.sp] = 0b11110100  # 0xf4
 
-        self.ram = [0] * 256
+        self.ram = bytearray(256)
+        # View of RAM for bulk loads and snapshots without copying
+        self.memory = memoryview(self.ram)
         self.pc = 0
         self.fl = 0b00000000
 
@@ -78,61 +150,81 @@ class CPU:
         self.ops[PRA] = self.handle_PRA
         self.ops[IRET] = self.handle_IRET
 
-        self.ops[ADD] = self.alu
-        self.ops[MUL] = self.alu
-        self.ops[SUB] = self.alu
-        self.ops[DIV] = self.alu
-        self.ops[MOD] = self.alu
-        self.ops[DEC] = self.alu
-        self.ops[INC] = self.alu
-        self.ops[AND] = self.alu
-        self.ops[OR] = self.alu
-        self.ops[XOR] = self.alu
-        self.ops[SHR] = self.alu
-        self.ops[SHL] = self.alu
-        self.ops[NOT] = self.alu
-        self.ops[CMP] = self.alu
-        self.ops[ADDI] = self.alu
-
-        self.alu_ops = {}
-        self.alu_ops[0b0010] = 'MUL'
-        self.alu_ops[0b0000] = 'ADD'
-        self.alu_ops[0b0001] = 'SUB'
-        self.alu_ops[0b0011] = 'DIV'
-        self.alu_ops[0b0100] = 'MOD'
-        self.alu_ops[0b0110] = 'DEC'
-        self.alu_ops[0b1000] = 'AND'
-        self.alu_ops[0b1010] = 'OR'
-        self.alu_ops[0b1011] = 'XOR'
-        self.alu_ops[0b1101] = 'SHR'
-        self.alu_ops[0b1100] = 'SHL'
-        self.alu_ops[0b1001] = 'NOT'
-        self.alu_ops[0b0101] = 'INC'
-        self.alu_ops[0b0111] = 'CMP'
-        self.alu_ops[0b1111] = 'ADDI'
-
+        # ALU instructions are bound straight to their own handlers
+        self.ops[ADD] = self.handle_ADD
+        self.ops[MUL] = self.handle_MUL
+        self.ops[SUB] = self.handle_SUB
+        self.ops[DIV] = self.handle_DIV
+        self.ops[MOD] = self.handle_MOD
+        self.ops[DEC] = self.handle_DEC
+        self.ops[INC] = self.handle_INC
+        self.ops[AND] = self.handle_AND
+        self.ops[OR] = self.handle_OR
+        self.ops[XOR] = self.handle_XOR
+        self.ops[SHR] = self.handle_SHR
+        self.ops[SHL] = self.handle_SHL
+        self.ops[NOT] = self.handle_NOT
+        self.ops[CMP] = self.handle_CMP
+        self.ops[ADDI] = self.handle_ADDI
+
+        # Decode cache: one (handler, operands, next_pc) record per RAM address.
+        # next_pc is None for instructions that set the PC themselves.
+        self.decoded = [None] * CACHE_SIZE
+        # The same for interpret(), with pairs of instructions that often go
+        # together fused into one record (see fuse()). Each record is
+        # (handler, operands, next_pc, count), count being how many
+        # instructions it executes.
+        self.fused = [None] * CACHE_SIZE
+
+        # Basic-block compiler used by run_jit(), created on first use
+        self.jit = None
+
+        # When a profiler.Profiler is attached, run() uses its counting loop
+        self.profiler = None
+
+        # Likewise a journal.Journal, which records how to undo each step
+        self.journal = None
+
+        # devices.Bus for memory-mapped devices, if one is attached
+        self.bus = None
+        # Functions check_interrupts() calls to let input devices set their
+        # bits in IS
+        self.pollers = []
+
+        # Instructions executed so far
+        self.cycles = 0
+        # run() calls check_interrupts() once cycles reaches this count.
+        # Setting it to 0 forces a check before the next instruction.
+        self.deadline = 0
+        # run() returns once cycles reaches this count
+        self.cycle_limit = float('inf')
+        # Cleared while an interrupt handler runs (between the jump to the
+        # handler and its IRET)
+        self.interrupts_enabled = True
+
+        # When the timer's current second started: wall-clock time, or the
+        # cycle count with a virtual clock. timer_start is None right after
+        # an IRET, which can't see the current cycle count from inside the
+        # run loop; the next check_interrupts() fills it in.
+        self.clock_hz = clock_hz
         self.start_time = time.time()
+        self.timer_start = 0
 
-    def load(self):
-        """Load a program into memory."""
-        program = []
-
-        # If a file is specified as the argument, load that file
-        if len(sys.argv) > 1:
-            file_to_load = sys.argv[1]
-            address = 0
-
-            with open(os.path.join(sys.path[0], file_to_load), 'r') as f:
-                for line in f:
-                    string_val = line.split("#")[0].strip()
-                    if string_val == '':
-                        continue
-                    bin_val = int(string_val, 2)
-                    self.ram[address] = bin_val
-                    address += 1
+    def load(self, program=None):
+        """
+        Load a program into memory. program can be the bytes of the program,
+        or the path of a .ls8 file, .asm source, .bin file or .ls8b image.
+        Text and source files are parsed once and then loaded from the image
+        cache.
+        """
+        if isinstance(program, str):
+            try:
+                program = load_program(program)
+            except ValueError as e:
+                raise CPUError(str(e))
 
-        else:
-            # If not argument, use hard-coded program:
+        elif program is None:
+            # If no program is given, use hard-coded program:
 
             program = [
                 # From print8.ls8
@@ -143,159 +235,313 @@ class CPU:
                 0b00000000,
                 0b00000001,  # HLT
             ]
-            '''
-            # Use the following if you want to print an error message and exit instead:
-            print("Error: Filename of program to run is needed")
-            sys.exit(1)
-            '''
 
-        address = 0
+        self.load_bytes(bytes(program))
+
+    def load_bytes(self, data, address=0):
+        """Copy a whole program or data image into RAM starting at address."""
+        end = address + len(data)
+        if end > len(self.ram):
+            raise CPUError("Program is too large: " +
+                           str(len(data)) + " bytes")
+        self.memory[address:end] = data
+        self.flush_decoded()
+
+    def flush_decoded(self):
+        # Forget every decoded instruction and compiled block
+        self.decoded[:] = [None] * CACHE_SIZE
+        self.fused[:] = [None] * CACHE_SIZE
+        if self.jit is not None:
+            self.jit.clear()
+
+    def snapshot(self):
+        """Capture the full machine state as a Snapshot."""
+        return Snapshot(
+            bytes(self.reg),
+            bytes(self.ram),
+            self.pc,
+            self.fl,
+            self.cycles,
+            self.interrupts_enabled,
+            self.timer_elapsed(),
+            self.output.getvalue(),
+            self.clock_hz,
+        )
+
+    def timer_elapsed(self):
+        # How far into its second the timer is
+        if self.clock_hz is None:
+            return time.time() - self.start_time
+        if self.timer_start is None:
+            return 0
+        return self.cycles - self.timer_start
+
+    def restore(self, snapshot):
+        """
+        Put the machine back in the state captured by snapshot(). RAM and
+        registers are copied in place. Decoded instructions are kept when
+        RAM is unchanged, which makes resetting between runs cheap.
+        """
+        if self.ram != snapshot.ram:
+            self.memory[:] = snapshot.ram
+            self.flush_decoded()
+        self.reg[:] = snapshot.reg
+        self.pc = snapshot.pc
+        self.fl = snapshot.fl
+        self.cycles = snapshot.cycles
+        self.interrupts_enabled = snapshot.interrupts_enabled
+        self.clock_hz = snapshot.clock_hz
+        if self.clock_hz is None:
+            self.start_time = time.time() - snapshot.timer_elapsed
+        else:
+            self.timer_start = snapshot.cycles - snapshot.timer_elapsed
+        self.deadline = 0
 
-        for instruction in program:
-            self.ram[address] = instruction
-            address += 1
+        if snapshot.output is not None and isinstance(self.output, MemorySink):
+            self.output.reset(snapshot.output)
+
+    @classmethod
+    def fork(cls, snapshot, output=None):
+        """
+        Start a new CPU from a snapshot. The child gets its own 256 bytes of
+        RAM copied from the snapshot's, and captures its output in memory
+        (continuing from the snapshot's output) unless output is given.
+        """
+        if output is None:
+            output = MemorySink(snapshot.output or '')
+        child = cls(output=output, clock_hz=snapshot.clock_hz)
+        child.restore(snapshot._replace(output=None))
+        return child
 
     def ram_read(self, mar):
         # Accept the address to read and return the value stored there
 
         # mar <- the address that is being read
         # return mdr <- the data that was read
-        if mar < len(self.ram):
+        if 0 <= mar < len(self.ram):
             # print("current mar: " + str(mar))
             return self.ram[mar]
         else:
-            print("MAR is too high: " + str(mar))
-            sys.exit(1)
+            raise CPUError("MAR is too high: " + str(mar))
 
     def ram_write(self, mdr, mar):
         # Accept a value to write, and the address to write it to
 
         # mdr <- the data to write
         # mar <- the address that is being written to
-        self.ram[mar] = mdr
+        if not 0 <= mar < len(self.ram):
+            raise CPUError("MAR is too high: " + str(mar))
+        self.ram[mar] = mdr & 0xFF
+        self.invalidate(mar)
+
+    def invalidate(self, mar):
+        # Drop any decoded instruction that includes the byte at mar.
+        # Instructions are at most 3 bytes long, so only the entries starting
+        # at mar, mar - 1 and mar - 2 can cover it. A fused pair is at most 5
+        # bytes long, so for those it's the entries from mar - 4 on.
+        if mar >= 4:
+            self.decoded[mar - 4:mar + 1] = CLEARED
+            self.fused[mar - 4:mar + 1] = CLEARED
+        else:
+            for address in range(0, mar + 1):
+                self.decoded[address] = None
+                self.fused[address] = None
 
-    def alu(self, op, register_a, register_b=None):
-        """ALU operations."""
+        if self.jit is not None:
+            self.jit.invalidate(mar)
 
-        # op = self.alu_ops[self.ram_read(self.pc) & 0b00001111]
-
-        if op == "ADD":
-            # Add the values in two registers and store the result in register_a.
-            # self.reg[register_a] += self.reg[register_b]
-            total = self.reg[register_a] + self.reg[register_b]
-            # To keep register value within range 0-255
-            self.reg[register_a] = total & 0xFF
-
-        elif op == 'SUB':
-            # Subtract the value in the second register from the first, storing the result in register_a.
-            difference = self.reg[register_a] - self.reg[register_b]
-            # To keep register value within range 0-255
-            self.reg[register_a] = difference & 0xFF
-
-        elif op == 'MUL':
-            # Multiply the values in two registers together and store the result in register_a.
-            # self.reg[register_a] *= self.reg[register_b]
-            product = self.reg[register_a] * self.reg[register_b]
-            # To keep register value within range 0-255
-            self.reg[register_a] = product & 0xFF
-
-        elif op == 'DIV':
-            # Divide the value in the first register by the value in the second, storing the result in register_a.
-            if self.reg[register_b] == 0:
-                print("Division by 0 is not allowed.")
-                sys.exit(1)
-            quotient = self.reg[register_a] // self.reg[register_b]
-            self.reg[register_a] = quotient & 0xFF
-
-        elif op == 'MOD':
-            # Divide the value in the first register by the value in the second, storing the remainder of the result in registerA.
-            if self.reg[register_b] == 0:
-                print("Division by 0 is not allowed.")
-                sys.exit(1)
-            remainder = self.reg[register_a] % self.reg[register_b]
-            self.reg[register_a] = remainder & 0xFF
-
-        elif op == 'AND':
-            # Bitwise-AND the values in register_a and register_b, then store the result in register_a.
-            result = self.reg[register_a] & self.reg[register_b]
-            # print('{0:08b}'.format(self.reg[register_a]))
-            # print('{0:08b}'.format(self.reg[register_b]))
-            self.reg[register_a] = result
-            # print('{0:08b}'.format(self.reg[register_a]))
-
-        elif op == 'OR':
-            # Perform a bitwise-OR between the values in register_a and register_b, storing the result in register_a.
-            result = self.reg[register_a] | self.reg[register_b]
-            # print('{0:08b}'.format(self.reg[register_a]))
-            # print('{0:08b}'.format(self.reg[register_b]))
-            self.reg[register_a] = result
-            # print('{0:08b}'.format(self.reg[register_a]))
-
-        elif op == 'XOR':
-            # Perform a bitwise-XOR between the values in register_a and register_b, storing the result in register_a.
-            result = self.reg[register_a] ^ self.reg[register_b]
-            # print('{0:08b}'.format(self.reg[register_a]))
-            # print('{0:08b}'.format(self.reg[register_b]))
-            self.reg[register_a] = result
-            # print('{0:08b}'.format(self.reg[register_a]))
-
-        elif op == 'SHR':
-            # Shift the value in register_a right by the number of bits specified in register_b, filling the high bits with 0.
-            # print('{0:08b}'.format(self.reg[register_a]))
-            self.reg[register_a] = self.reg[register_a] >> self.reg[register_b]
-            # print('{0:08b}'.format(self.reg[register_a]))
-
-        elif op == 'SHL':
-            # Shift the value in register_a left by the number of bits specified in register_b, filling the low bits with 0.
-            # print('{0:08b}'.format(self.reg[register_a]))
-            result = self.reg[register_a] << self.reg[register_b]
-            self.reg[register_a] = result & 0xFF
-            # print('{0:08b}'.format(self.reg[register_a]))
-
-        elif op == 'NOT':
-            # Perform a bitwise-NOT on the value in a register, storing the result in the register.
-            # print('{0:08b}'.format(self.reg[register_a]))
-            # One way:
-            # self.reg[register_a] = (1 << 8) - 1 - self.reg[register_a]
-            # Another way:
-            # self.reg[register_a] = ~self.reg[register_a] & ((1 << 8) - 1)
-            # print('{0:08b}'.format(self.reg[register_a]))
-            # Another way:
-            self.reg[register_a] = int(bin(~self.reg[register_a] & 0xff), 2)
-            # print('{0:08b}'.format(self.reg[register_a]))
-
-        elif op == 'DEC':
-            # Decrement (subtract 1 from) the value in the given register
-            self.reg[register_a] -= 1
-
-        elif op == 'INC':
-            # Increment (add 1 to) the value in the given register
-            # print('Value before INC: ', str(self.reg[register_a]))
-            self.reg[register_a] += 1
-            # print('Value after INC: ', str(self.reg[register_a]))
-
-        elif op == 'CMP':
-            # FL bits: 00000LGE
-            # Compare the values in two registers.
-            # If they are equal, set the Equal E flag to 1, otherwise set it to 0.
-            if self.reg[register_a] == self.reg[register_b]:
-                self.fl = 0b00000001
-            # If register_a is less than register_b, set the Less-than L flag to 1, otherwise set it to 0.
-            elif self.reg[register_a] < self.reg[register_b]:
-                self.fl = 0b00000100
-            # If register_a is greater than registerB, set the Greater-than G flag to 1, otherwise set it to 0.
-            elif self.reg[register_a] > self.reg[register_b]:
-                self.fl = 0b00000010
-            # print('self.fl:' + '{0:08b}'.format(self.fl))
-
-        elif op == 'ADDI':
-            # Add an immediate value to a register
-            immediate = register_b
-            self.reg[register_a] = self.reg[register_a] + immediate
+    def decode(self, pc):
+        """
+        Decode the instruction at pc into a (handler, operands, next_pc) record
+        and store it in the decode cache.
+        """
+        # Read the memory address stored in register PC (Program Counter) and store result in IR (Instruction Register)
+        ir = self.ram_read(pc)
 
+        if ir in self.ops:
+            handler = self.ops[ir]
         else:
+            # Stop if the instruction is not a valid option
+            raise CPUError("Unknown instruction " +
+                           str(ir) + " at " + str(pc))
+
+        # Use bitwise-AND and shifting to get the relevant bits.
+        num_operands = (ir & 0b11000000) >> 6
+
+        # Check to see if the instruction handler sets the PC directly.
+        sets_pc = (ir & 0b00010000) >> 4
+
+        # Read the bytes at PC+1 and PC+2 if the instruction needs them.
+        operands = tuple(self.ram_read(pc + i)
+                         for i in range(1, num_operands + 1))
+
+        # Every operand names a register, except the immediate value of
+        # LDI and ADDI
+        registers = operands[:1] if ir in (LDI, ADDI) else operands
+        for register in registers:
+            if register > 7:
+                raise CPUError("Invalid register " + str(register) +
+                               " at " + str(pc))
+
+        if sets_pc:
+            next_pc = None
+        else:
+            next_pc = pc + 1 + num_operands
+
+        entry = (handler, operands, next_pc)
+        self.decoded[pc] = entry
+        return entry
+
+    def fuse(self, pc):
+        """
+        Decode the instruction at pc for interpret(), together with the one
+        after it if the two are one of these pairs:
+
+            CMP + conditional jump
+            LDI + JMP, CALL or conditional jump
+            POP + POP or RET
+
+        Store a (handler, operands, next_pc, count) record in the fused
+        cache and return it. A fused pair runs as a single handler and
+        counts as two instructions. No pair starts with an instruction that
+        writes RAM, so the second one can't change under it.
+        """
+        handler, operands, next_pc = self.decoded[pc] or self.decode(pc)
+        entry = (handler, operands, next_pc, 1)
+
+        first = self.ram_read(pc)
+        if next_pc is not None and first in (CMP, LDI, POP):
+            try:
+                second = self.ram_read(next_pc)
+                _, second_operands, _ = \
+                    self.decoded[next_pc] or self.decode(next_pc)
+            except CPUError:
+                # Leave the error until the PC gets there
+                second = None
+
+            if second is not None:
+                after = next_pc + 1 + len(second_operands)
+
+            if first == CMP and second in JUMP_FLAGS:
+                entry = (self.handle_CMP_jump,
+                         operands + second_operands +
+                         (JUMP_FLAGS[second], after), None, 2)
+            elif first == LDI and second == JMP:
+                entry = (self.handle_LDI_JMP,
+                         operands + second_operands, None, 2)
+            elif first == LDI and second == CALL:
+                entry = (self.handle_LDI_CALL,
+                         operands + second_operands + (after,), None, 2)
+            elif first == LDI and second in JUMP_FLAGS:
+                entry = (self.handle_LDI_jump,
+                         operands + (self.ops[second], second_operands[0],
+                                     next_pc), None, 2)
+            elif first == POP and second == POP:
+                entry = (self.handle_POP_POP,
+                         operands + second_operands, after, 2)
+            elif first == POP and second == RET:
+                entry = (self.handle_POP_RET, operands, None, 2)
+
+        self.fused[pc] = entry
+        return entry
+
+    def alu(self, op, register_a, register_b=None):
+        """ALU operations."""
+        # run() calls the handle_<op> methods directly; this is kept for
+        # callers that still name the operation with a string like 'ADD'.
+        handler = getattr(self, "handle_" + op, None)
+        if handler is None:
             raise Exception("Unsupported ALU operation")
 
+        if register_b is None:
+            handler(register_a)
+        else:
+            handler(register_a, register_b)
+
+    def handle_ADD(self, register_a, register_b):
+        # Add the values in two registers and store the result in register_a.
+        total = self.reg[register_a] + self.reg[register_b]
+        # To keep register value within range 0-255
+        self.reg[register_a] = total & 0xFF
+
+    def handle_SUB(self, register_a, register_b):
+        # Subtract the value in the second register from the first, storing the result in register_a.
+        difference = self.reg[register_a] - self.reg[register_b]
+        # To keep register value within range 0-255
+        self.reg[register_a] = difference & 0xFF
+
+    def handle_MUL(self, register_a, register_b):
+        # Multiply the values in two registers together and store the result in register_a.
+        product = self.reg[register_a] * self.reg[register_b]
+        # To keep register value within range 0-255
+        self.reg[register_a] = product & 0xFF
+
+    def handle_DIV(self, register_a, register_b):
+        # Divide the value in the first register by the value in the second, storing the result in register_a.
+        if self.reg[register_b] == 0:
+            raise CPUError("Division by 0 is not allowed.")
+        quotient = self.reg[register_a] // self.reg[register_b]
+        self.reg[register_a] = quotient & 0xFF
+
+    def handle_MOD(self, register_a, register_b):
+        # Divide the value in the first register by the value in the second, storing the remainder of the result in registerA.
+        if self.reg[register_b] == 0:
+            raise CPUError("Division by 0 is not allowed.")
+        remainder = self.reg[register_a] % self.reg[register_b]
+        self.reg[register_a] = remainder & 0xFF
+
+    def handle_AND(self, register_a, register_b):
+        # Bitwise-AND the values in register_a and register_b, then store the result in register_a.
+        self.reg[register_a] = self.reg[register_a] & self.reg[register_b]
+
+    def handle_OR(self, register_a, register_b):
+        # Perform a bitwise-OR between the values in register_a and register_b, storing the result in register_a.
+        self.reg[register_a] = self.reg[register_a] | self.reg[register_b]
+
+    def handle_XOR(self, register_a, register_b):
+        # Perform a bitwise-XOR between the values in register_a and register_b, storing the result in register_a.
+        self.reg[register_a] = self.reg[register_a] ^ self.reg[register_b]
+
+    def handle_SHR(self, register_a, register_b):
+        # Shift the value in register_a right by the number of bits specified in register_b, filling the high bits with 0.
+        self.reg[register_a] = self.reg[register_a] >> self.reg[register_b]
+
+    def handle_SHL(self, register_a, register_b):
+        # Shift the value in register_a left by the number of bits specified in register_b, filling the low bits with 0.
+        result = self.reg[register_a] << self.reg[register_b]
+        self.reg[register_a] = result & 0xFF
+
+    def handle_NOT(self, register_a):
+        # Perform a bitwise-NOT on the value in a register, storing the result in the register.
+        self.reg[register_a] = ~self.reg[register_a] & 0xFF
+
+    def handle_DEC(self, register_a):
+        # Decrement (subtract 1 from) the value in the given register
+        self.reg[register_a] = (self.reg[register_a] - 1) & 0xFF
+
+    def handle_INC(self, register_a):
+        # Increment (add 1 to) the value in the given register
+        self.reg[register_a] = (self.reg[register_a] + 1) & 0xFF
+
+    def handle_CMP(self, register_a, register_b):
+        # FL bits: 00000LGE
+        # Compare the values in two registers.
+        value_a = self.reg[register_a]
+        value_b = self.reg[register_b]
+        # If they are equal, set the Equal E flag to 1, otherwise set it to 0.
+        if value_a == value_b:
+            self.fl = 0b00000001
+        # If register_a is less than register_b, set the Less-than L flag to 1, otherwise set it to 0.
+        elif value_a < value_b:
+            self.fl = 0b00000100
+        # If register_a is greater than registerB, set the Greater-than G flag to 1, otherwise set it to 0.
+        else:
+            self.fl = 0b00000010
+
+    def handle_ADDI(self, register_a, immediate):
+        # Add an immediate value to a register
+        self.reg[register_a] = (self.reg[register_a] + immediate) & 0xFF
+
     def trace(self):
         """
         Handy function to print out the CPU state. You might want to call this
@@ -338,22 +584,22 @@ class CPU:
 
     def handle_PRN(self, register):
         # Print to the console the decimal integer value that is stored in the given register.
-        print(self.reg[register])
+        self.output.write(str(self.reg[register]) + "\n")
 
     def handle_PRA(self, register):
         # Print to the console the ASCII character corresponding to the value in the given register.
-        # end="" should keep from going to a new line
-        print(chr(self.reg[register]), end="")
+        self.output.write(chr(self.reg[register]))
 
     def handle_HLT(self):
-        # Halt the CPU (and exit the emulator).
-        sys.exit(0)
+        # Halt the CPU. run() stops and returns a HALTED result.
+        self.output.flush()
+        raise Halt()
 
     def handle_PUSH(self, register):
         # Push the value in the given register on the stack.
 
         # Decrement the SP (stack pointer)
-        self.reg[self.sp] -= 1
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xFF
 
         # Copy the value in the given register to the address pointed to by SP
         # self.ram[self.reg[-1]] = self.reg[register]
@@ -372,21 +618,21 @@ class CPU:
         self.reg[register] = self.ram_read(self.reg[self.sp])
 
         # Increment SP (stack pointer)
-        self.reg[self.sp] += 1
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
 
     def handle_RET(self):
         # Return from subroutine.
         # Pop the value from the top of the stack and store it in the PC.
         self.pc = self.ram_read(self.reg[self.sp])
         # Increment the SP
-        self.reg[self.sp] += 1
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
 
     def handle_CALL(self, register):
         # Call a subroutine (function) at the address stored in the register.
 
         # Push the address of the instruction directly after CALL onto the stack.
         # Increment the SP
-        self.reg[self.sp] -= 1
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xFF
         # self.ram[self.reg[-1]] = pc + 2
         self.ram_write(self.pc + 2, self.reg[self.sp])
 
@@ -476,186 +722,274 @@ class CPU:
         # Pop off the FL register from the stack.
         self.fl = self.ram_read(self.reg[-1])
         # print("self.fl is now " + str(self.fl))
-        self.reg[self.sp] += 1
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
 
         # Pop off the return address from the stack and store it in PC
         self.pc = self.ram_read(self.reg[-1])
-        self.reg[self.sp] += 1
+        self.reg[self.sp] = (self.reg[self.sp] + 1) & 0xFF
         # print("back to address " + str(self.pc))
 
-        # Re-enable interrupts # need to modify this to handle mult interrupts
-        self.reg[5] = 1
+        # Re-enable interrupts, and deliver any that came in meanwhile
+        self.interrupts_enabled = True
+        self.output.flush()
+        self.deadline = 0
+        # Restart the timer's second
         self.start_time = time.time()
+        self.timer_start = None
+
+    # Fused pairs (see fuse()). Each does exactly what the two instructions
+    # do one after the other.
+
+    def handle_CMP_jump(self, register_a, register_b, register_c, flags,
+                        next_pc):
+        # CMP, then a conditional jump on the flags it just set
+        reg = self.reg
+        value_a = reg[register_a]
+        value_b = reg[register_b]
+        if value_a == value_b:
+            fl = 0b00000001
+        elif value_a < value_b:
+            fl = 0b00000100
+        else:
+            fl = 0b00000010
+        self.fl = fl
 
-    def run(self):  # , stdscr is 2nd arg for keyboard polling
-        """Run the CPU."""
-        # stdscr.nodelay(1)
+        if fl & flags:
+            self.pc = reg[register_c]
+        else:
+            self.pc = next_pc
 
-        while True:
-            '''
-            c = stdscr.getch()
-
-            if c == ord('q'):
-                sys.exit(0)
-            if c != -1:
-                stdscr.clear()
-                stdscr.refresh()
-                stdscr.move(0, 0)
-                print(c)
-                print("Time to fire keyboard interrupts")
-                # Set second bit in IS (AKA R6, self.reg[6], Interrupt Status)
-                initial_is = self.reg[6]
-                result = initial_is | 0b00000010
-                self.reg[6] = result
-            '''
-            # Check to see if one second has elapsed
-            current_time = time.time()
-            # print("Time difference: " + str(current_time - self.start_time))
-            if current_time - self.start_time > 1:
-                # print("Time to fire the timer interrupt")
-
-                # Set bit #0 in IS (AKA R6, self.reg[6], Interrupt Status)
-                initial_is = self.reg[6]
-                result = initial_is | 0b00000001
-                self.reg[6] = result
-                # print("set IS: " + str(self.reg[6]))
-                # self.reg[6] = 1
-
-            # Check to see if interrupts are enabled by looking at value of IM (AKA R5, self.reg[5], Interrupt Mask)
-            interrupts_enabled = self.reg[5] > 0
-
-            # If interrupts are enabled, bitwise-AND the IM with IS.
-            if interrupts_enabled:
-                # print("Interrupts_enabled check passed")
-                masked_interrupts = self.reg[5] & self.reg[6]
-
-                # Step through each bit of masked_interrupts and see which interrupts are set.
-                for i in range(8):
-                    # Right shift interrupts down by i, then mask with 1 to see if that bit was set
-                    interrupt_happened = (
-                        (masked_interrupts >> i) & 1) == 1
-
-                    if interrupt_happened:  # and i == 0:
-                        # Timer interrupt
-                        # print("Interrupt_happened")
-                        # Disable further interrupts
-                        self.reg[5] = 0
-
-                        # Clear the bit in the IS register
-                        initial_is = self.reg[6]
-                        result = initial_is ^ 0b00000001
-                        self.reg[6] = result
-                        # self.reg[6] = 0
-
-                        # Push the PC register on the stack.
-                        # print("Putting the PC on the stack: " + str(self.pc))
-                        self.reg[self.sp] -= 1
-                        self.ram_write(self.pc, self.reg[self.sp])
-
-                        # Push the FL register on the stack.
-                        self.reg[self.sp] -= 1
-                        self.ram_write(self.fl, self.reg[self.sp])
-
-                        # Push RO-R6 on the stack
-                        for i in range(7):
-                            self.handle_PUSH(i)  # self.reg[i]
-                        # Look up the address of the appropriate handler from the interrupt vector table.
-                        # And set the PC to the handler address
-                        # self.pc = self.ram[248] # F8, the first slot of the interrupt vector table
-                        self.pc = self.ram_read(248)
-                        # print(
-                        #     "Time to do the interrupt handling. Self.pc is now " + str(self.pc))
-                        break
-
-                    elif interrupt_happened and i == 1:
-                        # Keyboard interrupt
-                        # print("Interrupt_happened")
-                        # Disable further interrupts
-                        self.reg[5] = 0
-
-                        # Clear the 2nd bit in the IS register
-                        initial_is = self.reg[6]
-                        result = initial_is ^ 0b00000010
-                        self.reg[6] = result
-
-                        # Push the PC register on the stack.
-                        # print("Putting the PC on the stack: " + str(self.pc))
-                        self.reg[self.sp] -= 1
-                        self.ram_write(self.pc, self.reg[self.sp])
-
-                        # Push the FL register on the stack.
-                        self.reg[self.sp] -= 1
-                        self.ram_write(self.fl, self.reg[self.sp])
-
-                        # Push RO-R6 on the stack
-                        for i in range(7):
-                            self.handle_PUSH(i)  # self.reg[i]
-                        # Look up the address of the appropriate handler from the interrupt vector table.
-                        # And set the PC to the handler address
-                        # self.pc = self.ram[249] # F9, the second slot of the interrupt vector table
-                        self.pc = self.ram_read(249)
-                        # print(
-                        #     "Time to do the interrupt handling. Self.pc is now " + str(self.pc))
-                        break
-                    '''
-                    else:
-                        # print("Interrupt didn't happen?")
-                        not_important = True
-
-                        # else:
-                        # print("Interrupts_enabled check failed")
-                    '''
-
-            # Read the memory address stored in register PC (Program Counter) and store result in IR (Instruction Register)
-            ir = self.ram_read(self.pc)
-
-            if ir in self.ops:
-                ir_op = self.ops[ir]
-            else:
-                # Exit if the instruction is not a valid option
-                print("Unknown instruction " +
-                      str(ir) + " at " + str(self.pc))
-                sys.exit(1)
-
-            # Check to see which operands are needed for the instruction.
-
-            # Use bitwise-AND and shifting to get the relevant bits.
-            num_operands = (ir & 0b11000000) >> 6
-            # print("Num operands: " + str(num_operands))
-
-            # Check to see if the instruction handler sets the PC directly.
-            # Use bitwise-AND and shifting to get the relevant bits.
-            sets_pc = (ir & 0b00010000) >> 4
-
-            # Check to see if the instruction is handled by the ALU
-            handled_by_ALU = (ir & 0b00100000) >> 5
-
-            if handled_by_ALU:
-                op = self.alu_ops[self.ram_read(self.pc) & 0b00001111]
-
-            # Read the bytes at PC+1 and PC+2 if the instruction needs them.
-            # Perform the actions needed for the instruction.
-
-            if num_operands == 2:
-                operand_a = self.ram_read(self.pc + 1)
-                operand_b = self.ram_read(self.pc + 2)
-                if handled_by_ALU:
-                    ir_op(op, operand_a, operand_b)
-                else:
-                    ir_op(operand_a, operand_b)
-                if not sets_pc:
-                    self.pc += 3
-
-            elif num_operands == 1:
-                operand_a = self.ram_read(self.pc + 1)
-                if handled_by_ALU:
-                    ir_op(op, operand_a)
-                else:
-                    ir_op(operand_a)
-                if not sets_pc:
-                    self.pc += 2
+    def handle_LDI_JMP(self, register, immediate, register_c):
+        # LDI, then JMP
+        self.reg[register] = immediate
+        self.pc = self.reg[register_c]
+
+    def handle_LDI_CALL(self, register, immediate, register_c,
+                        return_address):
+        # LDI, then CALL
+        reg = self.reg
+        reg[register] = immediate
+        reg[self.sp] = (reg[self.sp] - 1) & 0xFF
+        self.ram_write(return_address, reg[self.sp])
+        self.pc = reg[register_c]
+
+    def handle_LDI_jump(self, register, immediate, jump, register_c,
+                        jump_pc):
+        # LDI, then a conditional jump, whose handler works out the next PC
+        # from its own address
+        self.reg[register] = immediate
+        self.pc = jump_pc
+        jump(register_c)
+
+    def handle_POP_POP(self, register_a, register_b):
+        # Two POPs
+        reg = self.reg
+        reg[register_a] = self.ram_read(reg[self.sp])
+        reg[self.sp] = (reg[self.sp] + 1) & 0xFF
+        reg[register_b] = self.ram_read(reg[self.sp])
+        reg[self.sp] = (reg[self.sp] + 1) & 0xFF
+
+    def handle_POP_RET(self, register):
+        # POP, then RET
+        reg = self.reg
+        reg[register] = self.ram_read(reg[self.sp])
+        reg[self.sp] = (reg[self.sp] + 1) & 0xFF
+        self.pc = self.ram_read(reg[self.sp])
+        reg[self.sp] = (reg[self.sp] + 1) & 0xFF
+
+    def raise_interrupt(self, number):
+        # Set the bit for the interrupt in IS (AKA R6, self.reg[6], Interrupt Status)
+        self.reg[6] |= 1 << number
+        # Make run() look at it before the next instruction
+        self.deadline = 0
+
+    def check_interrupts(self):
+        """
+        Fire the timer if a second has passed, then jump to the handler of the
+        lowest pending interrupt that is enabled. run() calls this every
+        TIMER_POLL_INTERVAL instructions, or sooner after raise_interrupt().
+        With a virtual clock it is also called on the exact cycle the timer
+        is due.
+        """
+        self.deadline = min(self.cycles + TIMER_POLL_INTERVAL, self.cycle_limit)
+
+        if self.clock_hz is not None:
+            if self.timer_start is None:
+                self.timer_start = self.cycles
 
+            next_tick = self.timer_start + self.clock_hz
+            if self.cycles >= next_tick:
+                # Set bit #0 in IS for the timer interrupt
+                self.reg[6] |= 0b00000001
             else:
-                ir_op()
-                if not sets_pc:
-                    self.pc += 1
+                # Come back exactly when the second is up
+                self.deadline = min(self.deadline, next_tick)
+
+        # Check to see if one second has elapsed
+        elif time.time() - self.start_time > 1:
+            # Set bit #0 in IS for the timer interrupt
+            self.reg[6] |= 0b00000001
+
+        for poll in self.pollers:
+            poll()
+
+        if not self.interrupts_enabled:
+            return
+
+        # Bitwise-AND the IM (AKA R5) with IS (AKA R6)
+        masked_interrupts = self.reg[5] & self.reg[6]
+
+        if masked_interrupts:
+            # Isolate the lowest set bit to find the interrupt number
+            lowest = masked_interrupts & -masked_interrupts
+            self.interrupt(lowest.bit_length() - 1)
+
+    def interrupt(self, number):
+        """Jump to the handler for the given interrupt."""
+        # Disable further interrupts
+        self.interrupts_enabled = False
+        self.output.flush()
+
+        # Clear the bit in the IS register
+        self.reg[6] &= ~(1 << number) & 0xFF
+
+        # Push the PC register on the stack.
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xFF
+        self.ram_write(self.pc, self.reg[self.sp])
+
+        # Push the FL register on the stack.
+        self.reg[self.sp] = (self.reg[self.sp] - 1) & 0xFF
+        self.ram_write(self.fl, self.reg[self.sp])
+
+        # Push RO-R6 on the stack
+        for i in range(7):
+            self.handle_PUSH(i)
+
+        # Look up the address of the appropriate handler from the interrupt
+        # vector table (starting at F8) and set the PC to it.
+        self.pc = self.ram_read(0xF8 + number)
+
+    def run(self, max_cycles=None):
+        """
+        Run the CPU until the program halts, hits an error or has executed
+        max_cycles more instructions. Returns a RunResult. Calling run()
+        again after MAX_CYCLES carries on from where it stopped.
+        """
+        if self.profiler is not None:
+            return self.execute(self.profiler.interpret, max_cycles)
+        if self.journal is not None:
+            return self.execute(self.journal.interpret, max_cycles)
+        return self.execute(self.interpret, max_cycles)
+
+    def run_jit(self, max_cycles=None):
+        """
+        Like run(), but compiles each basic block of the program into a
+        Python function. Interrupts are checked between blocks only. While a
+        profiler or journal is attached, this is the same as run().
+        """
+        from jit import BlockCompiler
+
+        if self.profiler is not None or self.journal is not None:
+            # Compiled blocks can't count instructions for a profiler or
+            # record undo steps
+            return self.run(max_cycles)
+
+        if self.jit is None:
+            self.jit = BlockCompiler(self)
+        return self.execute(self.jit.run, max_cycles)
+
+    def execute(self, loop, max_cycles):
+        # Run one of the execution loops and describe why it stopped
+        if max_cycles is None:
+            self.cycle_limit = float('inf')
+        else:
+            self.cycle_limit = self.cycles + max_cycles
+        # Make the loop look at the new limit straight away
+        self.deadline = 0
+
+        error = None
+        try:
+            loop()
+        except Halt:
+            # Count the HLT instruction itself
+            self.cycles += 1
+            reason = HALTED
+        except CPUError as e:
+            reason = ERROR
+            error = str(e)
+        else:
+            reason = MAX_CYCLES
+        finally:
+            self.output.flush()
+
+        # Text printed so far, if the output is being captured
+        return RunResult(reason, self.cycles, self.output.getvalue(), error)
+
+    def interpret(self):
+        """
+        Execute instructions (one at a time, or a fused pair at a time) until
+        self.cycle_limit is reached. HLT and errors leave this loop by
+        raising Halt or CPUError.
+        """
+        decoded = self.decoded
+        fused = self.fused
+        # Count instructions in a local, and store it back when checking
+        # interrupts or leaving the loop
+        cycles = self.cycles
+
+        try:
+            while True:
+                deadline = self.deadline
+                if cycles >= deadline:
+                    self.cycles = cycles
+                    if cycles >= self.cycle_limit:
+                        return
+                    self.check_interrupts()
+                    deadline = self.deadline
+
+                # Fetch the decoded instruction, decoding it on first use
+                entry = fused[self.pc]
+                if entry is None:
+                    entry = self.fuse(self.pc)
+                handler, operands, next_pc, count = entry
+
+                if count > 1 and cycles + count > deadline:
+                    # Interrupts are due between the two: run the first
+                    # one on its own
+                    handler, operands, next_pc = \
+                        decoded[self.pc] or self.decode(self.pc)
+                    count = 1
+
+                # Perform the actions needed for the instruction.
+                handler(*operands)
+                if next_pc is not None:
+                    self.pc = next_pc
+                cycles += count
+        finally:
+            self.cycles = cycles
+
+
+def run_program(program, max_cycles=None, jit=False, clock_hz=None):
+    """
+    Load and run a program (bytes, or the path of a .ls8/.ls8b file) on a new
+    CPU, capturing what it prints. Returns a RunResult.
+    """
+    cpu = CPU(output=MemorySink(), clock_hz=clock_hz)
+
+    try:
+        cpu.load(program)
+    except CPUError as e:
+        return RunResult(ERROR, 0, '', str(e))
+
+    if jit:
+        return cpu.run_jit(max_cycles)
+    return cpu.run(max_cycles)
+
+
+def clock_rate(text):
+    # argparse type for the --clock-hz options: instructions per second of
+    # the virtual clock, at least 1
+    value = int(text)
+    if value < 1:
+        raise ValueError(text)
+    return value
@@ -0,0 +1,268 @@
+"""
+Memory-mapped devices for the LS-8.
+
+A Bus maps address ranges of RAM to device objects. Reads and writes of a
+mapped address (by LD, ST, PUSH, POP, CALL and so on) go to the device
+instead of RAM:
+
+    cpu = CPU()
+    bus = Bus(cpu)
+    keyboard = Keyboard(cpu)
+    bus.map(KEYBOARD_ADDRESS, keyboard)
+    bus.map(DISK_ADDRESS, BlockStorage('disk.img'))
+    keyboard.feed(b"some input")
+
+While nothing is mapped the CPU uses its plain ram_read() and ram_write().
+Mapping the first device swaps in the bus's versions as instance attributes
+(the same way journal.Journal hooks ram_write), and unmapping the last one
+swaps them back. Both flush the decode cache and compiled blocks, since the
+JIT binds the RAM access functions into each block.
+
+Device state isn't part of CPU.snapshot().
+"""
+
+import os
+import time
+from collections import deque
+
+from cpu import *
+
+# Where ls8.py maps each device by default. 0xF4 is where the spec puts the
+# last key pressed, and the console takes F6 of the F5-F7 the spec leaves
+# unused. The disk and timer don't fit there, so they sit in the space the
+# stack grows down into from F3: a program using them must keep its stack
+# above E7 (12 bytes deep at most), or be run with ls8.py's --disk-at and
+# --timer-at to map them somewhere else.
+KEYBOARD_ADDRESS = 0xF4
+CONSOLE_ADDRESS = 0xF6
+DISK_ADDRESS = 0xE0
+TIMER_ADDRESS = 0xE4
+
+# Interrupt the keyboard raises when a byte is waiting
+KEYBOARD_INTERRUPT = 1
+
+
+class Device:
+    """
+    Base class for memory-mapped devices. A device covers `size` addresses
+    and sees reads and writes as offsets from the start of its range.
+    """
+
+    size = 1
+
+    def read(self, offset):
+        return 0
+
+    def write(self, offset, value):
+        pass
+
+
+class Console(Device):
+    """Prints each byte written to it as a character, like PRA."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+
+    def write(self, offset, value):
+        self.cpu.output.write(chr(value))
+
+
+class Keyboard(Device):
+    """
+    A FIFO of input bytes.
+
+    offset 0: reading takes the next byte (0 when there is none)
+    offset 1: reading gives the number of bytes waiting (at most 255)
+
+    With a cpu, the keyboard interrupt is raised whenever a byte is waiting,
+    so a program like keyboard.ls8 gets one interrupt per byte. The
+    keyboard checks for that each time the CPU checks its interrupts, since
+    an IRET restores IS as it was before the handler ran.
+    """
+
+    size = 2
+
+    def __init__(self, cpu=None, interrupt=KEYBOARD_INTERRUPT):
+        self.cpu = cpu
+        self.interrupt = interrupt
+        self.buffer = deque()
+
+        if cpu is not None:
+            cpu.pollers.append(self.poll)
+
+    def feed(self, data):
+        """Queue bytes (or a str) of input."""
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer.extend(data)
+
+        if self.cpu is not None and self.buffer:
+            self.cpu.raise_interrupt(self.interrupt)
+
+    def poll(self):
+        # Keep the interrupt pending while there's something to read
+        if self.buffer:
+            self.cpu.reg[6] |= 1 << self.interrupt
+
+    def read(self, offset):
+        if offset == 1:
+            return min(len(self.buffer), 0xFF)
+
+        if not self.buffer:
+            return 0
+
+        return self.buffer.popleft()
+
+
+class Timer(Device):
+    """
+    Milliseconds since the timer was created, read-only.
+
+    offsets 0-3: the count, least significant byte first. Reading offset 0
+    latches the count, so the other three bytes match it.
+    """
+
+    size = 4
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latched = 0
+
+    def read(self, offset):
+        if offset == 0:
+            self.latched = int((time.monotonic() - self.started) * 1000)
+        return (self.latched >> (8 * offset)) & 0xFF
+
+
+class BlockStorage(Device):
+    """
+    A disk of fixed-size blocks kept in a local file.
+
+    offset 0: block number
+    offset 1: position within the block
+    offset 2: data; reading or writing it moves to the next position
+
+    Blocks past the end of the file read as zeros; writing to one grows the
+    file.
+    """
+
+    size = 3
+
+    def __init__(self, path, block_size=256):
+        self.block_size = block_size
+        self.block = 0
+        self.position = 0
+
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self.file = open(path, 'r+b')
+
+    def read(self, offset):
+        if offset == 0:
+            return self.block
+        if offset == 1:
+            return self.position
+
+        self.file.seek(self.offset())
+        data = self.file.read(1)
+        self.advance()
+        return data[0] if data else 0
+
+    def write(self, offset, value):
+        if offset == 0:
+            self.block = value
+        elif offset == 1:
+            self.position = value % self.block_size
+        else:
+            self.file.seek(self.offset())
+            self.file.write(bytes([value]))
+            self.advance()
+
+    def offset(self):
+        # File offset of the current byte
+        return self.block * self.block_size + self.position
+
+    def advance(self):
+        self.position = (self.position + 1) % self.block_size
+
+    def close(self):
+        self.file.close()
+
+
+class Bus:
+    """Routes reads and writes of mapped addresses to devices."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        cpu.bus = self
+
+        # (device, offset) for each address, or None for plain RAM
+        self.slots = [None] * 256
+        self.devices = {}
+
+        # The RAM access functions that were in place before the bus took
+        # over, so it can hand everything else on to them
+        self.next_read = None
+        self.next_write = None
+        self.saved = None
+
+    def map(self, address, device):
+        """Map device at address. Raises CPUError if it doesn't fit."""
+        end = address + device.size
+        if address < 0 or end > 256:
+            raise CPUError("Device doesn't fit at " + str(address))
+        if any(self.slots[address:end]):
+            raise CPUError("Address " + str(address) + " is already mapped")
+
+        if not self.devices:
+            self.install()
+
+        for offset in range(device.size):
+            self.slots[address + offset] = (device, offset)
+        self.devices[device] = address
+
+    def unmap(self, device):
+        """Remove a device."""
+        address = self.devices.pop(device)
+        for offset in range(device.size):
+            self.slots[address + offset] = None
+
+        if not self.devices:
+            self.uninstall()
+
+    def install(self):
+        cpu = self.cpu
+        # Keep any hooks already in place, such as a journal's
+        self.saved = {name: vars(cpu)[name]
+                      for name in ('ram_read', 'ram_write') if name in vars(cpu)}
+        self.next_read = cpu.ram_read
+        self.next_write = cpu.ram_write
+        cpu.ram_read = self.ram_read
+        cpu.ram_write = self.ram_write
+        cpu.flush_decoded()
+
+    def uninstall(self):
+        cpu = self.cpu
+        for name in ('ram_read', 'ram_write'):
+            if name in self.saved:
+                setattr(cpu, name, self.saved[name])
+            else:
+                delattr(cpu, name)
+        cpu.flush_decoded()
+
+    def ram_read(self, mar):
+        if 0 <= mar < 256:
+            slot = self.slots[mar]
+            if slot is not None:
+                device, offset = slot
+                return device.read(offset)
+        return self.next_read(mar)
+
+    def ram_write(self, mdr, mar):
+        if 0 <= mar < 256:
+            slot = self.slots[mar]
+            if slot is not None:
+                device, offset = slot
+                device.write(offset, mdr & 0xFF)
+                return
+        self.next_write(mdr, mar)
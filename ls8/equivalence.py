@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Check that the execution engines agree.
+
+Each program is run to completion on a fresh CPU three ways: CPU.run() (the
+interpreter, with fused instruction pairs), CPU.run_jit() (compiled basic
+blocks) and the profiler's loop (one decoded instruction at a time, nothing
+fused). Why each stopped, the instruction count, the output, the registers,
+FL, the PC and all of RAM must come out the same:
+
+    equivalence.py                  # the examples and the built-in programs
+    equivalence.py prog.ls8 dir/    # just these
+
+The built-in programs rewrite their own code, which is where the decode
+caches and compiled blocks can go stale. Programs still running after
+--max-cycles instructions (e.g. ones waiting for interrupts) are skipped,
+since the JIT only checks interrupts between blocks.
+"""
+
+import argparse
+import os
+import sys
+
+from cpu import *
+from batch import find_programs
+from image import load_program
+from output import MemorySink
+from profiler import Profiler
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'examples')
+
+ENGINES = ['interp', 'jit', 'unfused']
+
+DEFAULT_MAX_CYCLES = 1000000
+
+
+def patch_ldi():
+    """
+    A loop that stores a new immediate into its own LDI each pass, from
+    inside the block being run. Prints 0 to 9.
+    """
+    return bytes([
+        LDI, 2, 5,          # 0:  R2 = address of the immediate below
+        LDI, 1, 0,          # 3:  loop: R1 = (patched each pass)
+        PRN, 1,             # 6:
+        INC, 1,             # 8:  R1 += 1
+        ST, 2, 1,           # 10: store R1 as the immediate at 5
+        LDI, 3, 10,         # 13:
+        CMP, 1, 3,          # 16: R1 == 10?
+        LDI, 3, 3,          # 19: (LDI leaves the flags alone)
+        JNE, 3,             # 22: no: loop
+        HLT,                # 24
+    ])
+
+
+def patch_jump():
+    """
+    A loop that turns its own JNE (the second half of a fused CMP/JNE pair)
+    into a JEQ once it has run, then goes round again. Prints 1 to 4.
+    """
+    return bytes([
+        LDI, 1, 3,          # 0:  R1 = 3
+        LDI, 2, 19,         # 3:  R2 = address of the jump in the loop
+        LDI, 3, JEQ,        # 6:  R3 = the opcode to patch in
+        LDI, 4, 12,         # 9:  R4 = address of the loop
+        INC, 0,             # 12: loop: R0 += 1
+        PRN, 0,             # 14:
+        CMP, 0, 1,          # 16: R0 == 3?
+        JNE, 4,             # 19: no: loop (JEQ once patched)
+        LD, 5, 2,           # 21: R5 = the jump's opcode
+        CMP, 5, 3,          # 24: already patched?
+        LDI, 5, 37,         # 27: (LDI leaves the flags alone)
+        JEQ, 5,             # 30: yes: halt
+        ST, 2, 3,           # 32: patch the jump to JEQ
+        JMP, 4,             # 35: and go round again
+        HLT,                # 37
+    ])
+
+
+def push_over_code():
+    """
+    A loop whose stack sits on its own code: the second pass PUSHes a HLT
+    over the JMP at its end, which has already run once. Prints 0 and 1.
+    """
+    return bytes([
+        LDI, 3, JMP,        # 0:  R3 = the JMP opcode
+        LDI, 2, 6,          # 3:  R2 = address of the loop
+        PRN, 1,             # 6:  loop:
+        INC, 1,             # 8:  R1 += 1
+        LDI, 7, 19,         # 10: SP = 19, so PUSH writes to 18
+        PUSH, 3,            # 13: the same JMP the first time, HLT the second
+        LDI, 3, HLT,        # 15:
+        JMP, 2,             # 18: back to the loop
+    ])
+
+
+BUILT_IN = [
+    ('patch_ldi', patch_ldi),
+    ('patch_jump', patch_jump),
+    ('push_over_code', push_over_code),
+]
+
+
+def run_engine(program, engine, max_cycles):
+    # Run a program on a fresh CPU; returns what is compared between engines
+    cpu = CPU(output=MemorySink())
+    cpu.load_bytes(program)
+
+    if engine == 'jit':
+        result = cpu.run_jit(max_cycles)
+    else:
+        if engine == 'unfused':
+            # The profiler runs its own, unfused copy of the loop
+            Profiler(cpu)
+        result = cpu.run(max_cycles)
+
+    return {
+        'reason': result.reason,
+        'cycles': result.cycles,
+        'output': result.output,
+        'error': result.error,
+        'reg': bytes(cpu.reg),
+        'fl': cpu.fl,
+        'pc': cpu.pc,
+        'ram': bytes(cpu.ram),
+    }
+
+
+def check(program, max_cycles):
+    """
+    Run a program on every engine. Returns None if it didn't stop within
+    max_cycles, otherwise a list of the differences found (empty if the
+    engines agree).
+    """
+    states = {engine: run_engine(program, engine, max_cycles)
+              for engine in ENGINES}
+
+    expected = states[ENGINES[0]]
+    if expected['reason'] == MAX_CYCLES:
+        return None
+
+    differences = []
+    for engine in ENGINES[1:]:
+        for key, value in states[engine].items():
+            if value != expected[key]:
+                differences.append(f"{engine} {key} differs")
+
+    return differences
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        description="Check that run(), run_jit() and the unfused loop agree.")
+    parser.add_argument('paths', nargs='*',
+                        help="programs, or directories of them (default: "
+                        "the examples and the built-in programs)")
+    parser.add_argument('--max-cycles', type=int, default=DEFAULT_MAX_CYCLES,
+                        help="skip programs still running after this many "
+                        "instructions")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    programs = []
+    if args.paths:
+        paths = [p for path in args.paths for p in find_programs(path)]
+    else:
+        paths = find_programs(EXAMPLES)
+        programs.extend((name, make()) for name, make in BUILT_IN)
+
+    for path in paths:
+        try:
+            programs.append((os.path.basename(path), load_program(path)))
+        except (OSError, ValueError) as e:
+            # e.g. exit_check.ls8, which isn't meant to load
+            print(f"skipped {os.path.basename(path)} ({e})")
+
+    failed = 0
+    for name, program in programs:
+        differences = check(program, args.max_cycles)
+
+        if differences is None:
+            print(f"skipped {name} (still running)")
+        elif differences:
+            failed += 1
+            print(f"DIFFERS {name}: {', '.join(differences)}")
+        else:
+            print(f"ok      {name}")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Binary program images for the LS-8.
+
+An image is a small header followed by the raw program bytes, so it can be
+loaded with a single read instead of parsing one line of text per byte.
+
+Header layout (little-endian, 20 bytes):
+
+    magic        4 bytes   b"LS8\\x00"
+    version      1 byte
+    reserved     1 byte
+    length       2 bytes   number of program bytes that follow (max 256)
+    source_mtime 8 bytes   st_mtime_ns of the .ls8 file it was built from
+    source_size  4 bytes   st_size of the .ls8 file it was built from
+
+Images built from a .ls8 file are cached in a __ls8cache__ directory next to
+it, in the same spirit as Python's __pycache__. A cached image is used as long
+as the source file's mtime and size still match the header.
+
+load_program() also takes assembler source (.asm), which is assembled in
+process with ../asm/asm.py and cached the same way, and raw binaries (.bin)
+as written by asm.py --binary.
+"""
+
+import os
+import struct
+import sys
+
+MAGIC = b"LS8\x00"
+VERSION = 1
+HEADER = struct.Struct("<4sBxHQI")
+
+# Extension for binary images
+IMAGE_EXTENSION = ".ls8b"
+
+# Directory (next to the source) that holds cached images
+CACHE_DIRECTORY = "__ls8cache__"
+
+# Assembler source, and raw program bytes with no header
+ASM_EXTENSION = ".asm"
+RAW_EXTENSION = ".bin"
+
+# Where asm.py lives
+ASM_DIRECTORY = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "asm")
+
+# Largest program that fits in RAM
+MAX_PROGRAM_SIZE = 256
+
+
+def parse_source(lines):
+    """
+    Parse the text of a .ls8 program (one binary number per line, # starts a
+    comment) into bytes. Raises ValueError for a value that isn't a byte.
+    """
+    program = bytearray()
+
+    for line in lines:
+        string_val = line.split("#")[0].strip()
+        if string_val == '':
+            continue
+        bin_val = int(string_val, 2)
+        if bin_val > 0xFF:
+            # RAM only holds bytes
+            raise ValueError("Invalid value " + str(bin_val) +
+                             " at " + str(len(program)))
+        program.append(bin_val)
+
+    if len(program) > MAX_PROGRAM_SIZE:
+        raise ValueError("Program is too large: " +
+                         str(len(program)) + " bytes")
+
+    return bytes(program)
+
+
+def assemble_source(text):
+    """
+    Assemble the text of a .asm program into bytes. Raises ValueError if it
+    doesn't assemble, with the assembler's reason as the message.
+    """
+    if ASM_DIRECTORY not in sys.path:
+        sys.path.insert(0, ASM_DIRECTORY)
+    from asm import AsmError, assemble
+
+    try:
+        program = assemble(text)
+    except AsmError as e:
+        raise ValueError("Assembly failed: " + str(e))
+
+    if len(program) > MAX_PROGRAM_SIZE:
+        raise ValueError("Program is too large: " +
+                         str(len(program)) + " bytes")
+
+    return program
+
+
+def read_raw(path):
+    """Load a raw binary: just the program bytes."""
+    with open(path, 'rb') as f:
+        program = f.read()
+
+    if len(program) > MAX_PROGRAM_SIZE:
+        raise ValueError("Program is too large: " +
+                         str(len(program)) + " bytes")
+
+    return program
+
+
+def pack_image(program, source_mtime=0, source_size=0):
+    """Return the image file contents for a program."""
+    return HEADER.pack(MAGIC, VERSION, len(program),
+                       source_mtime, source_size) + bytes(program)
+
+
+def unpack_image(data):
+    """
+    Split image file contents into (program, source_mtime, source_size).
+    Raises ValueError if data isn't a valid image.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Image is too short")
+
+    magic, version, length, source_mtime, source_size = \
+        HEADER.unpack_from(data)
+
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not an LS-8 image")
+    if length > MAX_PROGRAM_SIZE or len(data) != HEADER.size + length:
+        raise ValueError("Image length doesn't match its header")
+
+    program = data[HEADER.size:]
+    return program, source_mtime, source_size
+
+
+def read_image(path):
+    """Load the program bytes from an image file."""
+    with open(path, 'rb') as f:
+        program, _, _ = unpack_image(f.read())
+    return program
+
+
+def write_image(path, program, source_mtime=0, source_size=0):
+    """
+    Write a program out as an image file. It's written to a temporary file
+    and moved into place in one step, so another process loading the same
+    program (e.g. a batch.py worker) never sees half an image.
+    """
+    # One temporary name per process, in case two write the same image
+    temp = path + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(temp, 'wb') as f:
+            f.write(pack_image(program, source_mtime, source_size))
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def cache_path(source_path):
+    """Where the cached image for a .ls8 or .asm file lives."""
+    directory, name = os.path.split(source_path)
+    base, extension = os.path.splitext(name)
+    if extension != ".ls8":
+        # Keep foo.asm and foo.ls8 from sharing a cache entry
+        base = name
+    return os.path.join(directory, CACHE_DIRECTORY, base + IMAGE_EXTENSION)
+
+
+def load_program(path, use_cache=True):
+    """
+    Return the program bytes in path, which may be an image, a raw binary,
+    a .ls8 text file or a .asm source. Text files are parsed (or assembled)
+    once and then served from the image cache until they change.
+    """
+    if path.endswith(IMAGE_EXTENSION):
+        return read_image(path)
+    if path.endswith(RAW_EXTENSION):
+        return read_raw(path)
+
+    stat = os.stat(path)
+    cached = cache_path(path)
+
+    if use_cache:
+        try:
+            with open(cached, 'rb') as f:
+                program, source_mtime, source_size = unpack_image(f.read())
+            if (source_mtime, source_size) == (stat.st_mtime_ns, stat.st_size):
+                return program
+        except (OSError, ValueError):
+            # Missing or stale cache entry; fall through and rebuild it
+            pass
+
+    with open(path, 'r') as f:
+        if path.endswith(ASM_EXTENSION):
+            program = assemble_source(f.read())
+        else:
+            program = parse_source(f)
+
+    if use_cache:
+        try:
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            write_image(cached, program, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            # The cache is only an optimization (e.g. read-only directory)
+            pass
+
+    return program
+
+
+def main(argv):
+    """
+    Usage: image.py infile.ls8|infile.asm [outfile.ls8b]
+    """
+    if len(argv) not in (2, 3):
+        print("usage: image.py infile.ls8|infile.asm [outfile.ls8b]",
+              file=sys.stderr)
+        return 1
+
+    inputfile = argv[1]
+    if len(argv) == 3:
+        outputfile = argv[2]
+    else:
+        outputfile = os.path.splitext(inputfile)[0] + IMAGE_EXTENSION
+
+    try:
+        program = load_program(inputfile, use_cache=False)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    write_image(outputfile, program)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,287 @@
+"""Basic-block compiler for the LS-8 CPU."""
+
+from cpu import *
+
+# Instructions that end a basic block. Each of them may change the PC.
+BLOCK_ENDS = {JMP, JEQ, JNE, JGT, JLT, JLE, JGE, CALL, RET, IRET, HLT}
+
+# Longest block we compile, in instructions
+MAX_BLOCK_LENGTH = 64
+
+# Python source for the instructions that are inlined into a block.
+# {a} and {b} are the operand bytes.
+INLINE = {
+    LDI: "reg[{a}] = {b}",
+    ADD: "reg[{a}] = (reg[{a}] + reg[{b}]) & 0xFF",
+    SUB: "reg[{a}] = (reg[{a}] - reg[{b}]) & 0xFF",
+    MUL: "reg[{a}] = (reg[{a}] * reg[{b}]) & 0xFF",
+    AND: "reg[{a}] = reg[{a}] & reg[{b}]",
+    OR: "reg[{a}] = reg[{a}] | reg[{b}]",
+    XOR: "reg[{a}] = reg[{a}] ^ reg[{b}]",
+    SHR: "reg[{a}] = reg[{a}] >> reg[{b}]",
+    SHL: "reg[{a}] = (reg[{a}] << reg[{b}]) & 0xFF",
+    NOT: "reg[{a}] = ~reg[{a}] & 0xFF",
+    INC: "reg[{a}] = (reg[{a}] + 1) & 0xFF",
+    DEC: "reg[{a}] = (reg[{a}] - 1) & 0xFF",
+    ADDI: "reg[{a}] = (reg[{a}] + {b}) & 0xFF",
+    CMP: "value_a = reg[{a}]\n"
+         "value_b = reg[{b}]\n"
+         "cpu.fl = 1 if value_a == value_b else 4 if value_a < value_b else 2",
+    LD: "reg[{a}] = ram_read(reg[{b}])",
+    POP: "reg[{a}] = ram_read(reg[7])\n"
+         "reg[7] = (reg[7] + 1) & 0xFF",
+}
+
+# Conditions for the conditional jumps, matching the handle_J* methods
+CONDITIONS = {
+    JEQ: "cpu.fl & 0b00000001",
+    JNE: "not cpu.fl & 0b00000001",
+    JLT: "cpu.fl >> 2",
+    JLE: "cpu.fl >> 2 or cpu.fl & 0b00000001",
+    JGT: "cpu.fl >> 1 == 1",
+    JGE: "cpu.fl >> 1 == 1 or cpu.fl & 0b00000001",
+}
+
+
+class BlockCompiler:
+    """
+    Compiles the basic blocks of a program in RAM into Python functions and
+    runs them. A block starts at any address the PC lands on and runs up to
+    and including the next jump, CALL, RET, IRET or HLT.
+
+    Each compiled block is called with the number of instructions executed
+    so far and returns a (next_pc, instructions_executed) tuple. When an
+    instruction in it fails, it sets cpu.pc and cpu.cycles to where the
+    interpreter would have stopped before raising.
+    """
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # start address -> compiled function
+        self.blocks = {}
+        # start address -> address just past the block
+        self.block_ends = {}
+        # For each address, the start addresses of the blocks that cover it
+        self.owners = [[] for _ in range(256)]
+
+    def invalidate(self, mar):
+        # Throw away every block that includes the byte at mar
+        if not 0 <= mar < 256:
+            return
+        for start in self.owners[mar][:]:
+            self.drop(start)
+
+    def drop(self, start):
+        # Forget a compiled block and remove it from the owner lists
+        del self.blocks[start]
+        end = self.block_ends.pop(start)
+        for address in range(start, end):
+            self.owners[address].remove(start)
+
+    def clear(self):
+        # Forget every compiled block
+        for start in list(self.blocks):
+            self.drop(start)
+
+    def precompile(self, starts):
+        # Compile ahead of time the blocks starting at each address in
+        # starts (e.g. the basic blocks analyze.analyze() found)
+        for start in starts:
+            if start not in self.blocks:
+                self.compile(start)
+
+    def scan(self, start):
+        """
+        Decode the instructions of the block starting at start. Returns a
+        list of (pc, ir, a, b, next_pc) tuples.
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+
+        instructions = []
+        pc = start
+
+        while True:
+            # Stop before anything the interpreter would have to report as an
+            # error (including a PC past the end of RAM), so the error
+            # happens when the PC actually gets there.
+            try:
+                cpu.decode(pc)
+            except CPUError:
+                if not instructions:
+                    raise
+                break
+
+            ir = ram[pc]
+            num_operands = (ir & 0b11000000) >> 6
+            a = ram[pc + 1] if num_operands > 0 else None
+            b = ram[pc + 2] if num_operands > 1 else None
+            next_pc = pc + 1 + num_operands
+            instructions.append((pc, ir, a, b, next_pc))
+
+            pc = next_pc
+            if ir in BLOCK_ENDS:
+                break
+            if len(instructions) == MAX_BLOCK_LENGTH or pc >= len(ram):
+                break
+
+        return instructions
+
+    def compile(self, start):
+        """
+        Generate, compile and cache the block starting at start.
+        """
+        instructions = self.scan(start)
+        end = instructions[-1][4]
+
+        # A block ending in a jump runs again in place while the jump goes
+        # back to its start and no interrupt check is due. done counts the
+        # instructions of the passes already finished.
+        last = instructions[-1][1]
+        loops = last == JMP or last in CONDITIONS
+
+        lines = []
+        for count, (pc, ir, a, b, next_pc) in enumerate(instructions, 1):
+            # Instructions executed once this one is done, and before it
+            total = f"done + {count}" if loops else str(count)
+            before = f"done + {count - 1}" if loops else str(count - 1)
+
+            if ir in BLOCK_ENDS:
+                lines.extend(self.block_end(ir, a, pc, next_pc, total, before))
+            elif ir in INLINE:
+                lines.extend(INLINE[ir].format(a=a, b=b).split("\n"))
+            elif ir == ST:
+                # A write into this block means the rest of it is stale
+                lines.append(f"address = reg[{a}]")
+                lines.append(f"ram_write(reg[{b}], address)")
+                lines.append(f"if {start} <= address < END:")
+                lines.append(f"    return ({next_pc}, {total})")
+            elif ir == PUSH:
+                lines.append("reg[7] = (reg[7] - 1) & 0xFF")
+                lines.append(f"ram_write(reg[{a}], reg[7])")
+                lines.append(f"if {start} <= reg[7] < END:")
+                lines.append(f"    return ({next_pc}, {total})")
+            else:
+                # Anything else (PRN, PRA, DIV, MOD) goes through its handler.
+                # If it fails, leave the PC on it and count only the
+                # instructions before it, like the interpreter does.
+                num_operands = (ir & 0b11000000) >> 6
+                operands = ", ".join(str(o) for o in (a, b)[:num_operands])
+                lines.append("try:")
+                lines.append(f"    ops[{ir}]({operands})")
+                lines.append("except CPUError:")
+                lines.append(f"    cpu.pc = {pc}")
+                lines.append(f"    cpu.cycles = cycles + {before}")
+                lines.append("    raise")
+
+        if last not in BLOCK_ENDS:
+            # The block falls through into the next one
+            lines.append(f"return ({end}, {total})")
+
+        indent = "        "
+        if loops:
+            lines = ["done = 0", "while True:"] + ["    " + line for line in lines]
+        body = "\n".join(indent + line for line in lines)
+        source = (
+            "def make_block(cpu, reg, ram_read, ram_write, ops):\n"
+            f"    START = {start}\n"
+            f"    END = {end}\n"
+            "    def block(cycles):\n"
+            f"{body}\n"
+            "    return block\n"
+        )
+        namespace = {"CPUError": CPUError}
+        exec(compile(source, f"<ls8 block {start:02X}>", "exec"), namespace)
+        cpu = self.cpu
+        block = namespace["make_block"](
+            cpu, cpu.reg, cpu.ram_read, cpu.ram_write, cpu.ops)
+
+        self.blocks[start] = block
+        self.block_ends[start] = end
+        for address in range(start, end):
+            self.owners[address].append(start)
+
+        return block
+
+    def block_end(self, ir, a, pc, next_pc, total, before):
+        # Source for the instruction that ends a block. total is the number
+        # of instructions executed including this one, before the number
+        # executed ahead of it.
+        if ir == JMP or ir in CONDITIONS:
+            # Go round again if the jump is back to the start and the run
+            # loop wouldn't check interrupts before running the block again
+            lines = [
+                f"target = reg[{a}]",
+                f"if target == START and cycles + {total} < cpu.deadline:",
+                f"    done = {total}",
+                "    continue",
+                f"return (target, {total})",
+            ]
+            if ir == JMP:
+                return lines
+            return [f"if {CONDITIONS[ir]}:"] + \
+                ["    " + line for line in lines] + \
+                [f"return ({next_pc}, {total})"]
+
+        if ir == CALL:
+            # Push the return address, then jump to the address in the register
+            return [
+                "reg[7] = (reg[7] - 1) & 0xFF",
+                f"ram_write({(pc + 2) & 0xFF}, reg[7])",
+                f"return (reg[{a}], {total})",
+            ]
+
+        if ir == RET:
+            # Pop the return address
+            return [
+                "target = ram_read(reg[7])",
+                "reg[7] = (reg[7] + 1) & 0xFF",
+                f"return (target, {total})",
+            ]
+
+        if ir == HLT:
+            # HLT raises Halt, so count the instructions before it here.
+            # CPU.execute() counts the HLT itself.
+            return [
+                f"cpu.pc = {pc}",
+                f"cpu.cycles = cycles + {before}",
+                f"ops[{ir}]()",
+            ]
+
+        # IRET goes through its handler, which sets the PC
+        return [
+            f"ops[{ir}]()",
+            f"return (cpu.pc, {total})",
+        ]
+
+    def run(self):
+        """
+        Run compiled blocks until cpu.cycle_limit is reached. Interrupts are
+        only checked between blocks. A block runs to its end even if that
+        takes the count past the limit.
+        """
+        cpu = self.cpu
+        blocks = self.blocks
+        # Keep the PC and count in locals, and store them back when checking
+        # interrupts or compiling. Blocks store them themselves when they
+        # raise.
+        pc = cpu.pc
+        cycles = cpu.cycles
+
+        while True:
+            if cycles >= cpu.deadline:
+                cpu.pc = pc
+                cpu.cycles = cycles
+                if cycles >= cpu.cycle_limit:
+                    return
+                cpu.check_interrupts()
+                pc = cpu.pc
+
+            block = blocks.get(pc)
+            if block is None:
+                cpu.pc = pc
+                cpu.cycles = cycles
+                block = self.compile(pc)
+
+            pc, count = block(cycles)
+            cycles += count
@@ -0,0 +1,327 @@
+"""
+Reverse execution for the LS-8 CPU.
+
+Attach a Journal to a CPU and run() records, for every instruction, only what
+that instruction changed: the old PC, FL and interrupt-enable state, the old
+value of each register that changed, and the old byte at each RAM address
+written. That is enough to undo it:
+
+    cpu = CPU()
+    cpu.load('examples/call.ls8')
+    journal = Journal(cpu)
+    cpu.run()
+    journal.step_back()           # undo the last instruction
+    journal.run_back_to(0x18)     # undo until the PC is back at 18
+    journal.last_writer(0xF3)     # (step, pc) of the last write to F3
+
+Records are packed into bytearrays of CHUNK_STEPS records each, a few bytes
+per instruction, and the oldest chunk is dropped once more than `capacity`
+steps are held. A full snapshot is also kept every `checkpoint_interval`
+steps (at most MAX_CHECKPOINTS of them, spread over the whole run), so seek()
+can reach steps older than the undo records by restoring a checkpoint and
+running forward again.
+
+What the program printed is not undone.
+"""
+
+from collections import deque
+
+from cpu import *
+from output import NullSink
+
+# Records per chunk
+CHUNK_STEPS = 4096
+
+# Checkpoints kept at most; older ones are thinned out beyond this
+MAX_CHECKPOINTS = 64
+
+
+class Journal:
+    """Undo log of the instructions a CPU has executed."""
+
+    def __init__(self, cpu, capacity=1000000, checkpoint_interval=100000):
+        self.cpu = cpu
+        self.capacity = capacity
+        self.checkpoint_interval = checkpoint_interval
+
+        # Each chunk holds the records of CHUNK_STEPS consecutive steps.
+        # A record is its payload followed by one byte with the payload
+        # length, so chunks can be read backwards:
+        #   pc, fl, flags, changed register mask,
+        #   old value of each changed register (lowest register first),
+        #   (address, old byte) for each RAM write, in order
+        # Bit 0 of flags is interrupts_enabled. Bit 1 marks a record that
+        # isn't a step: interrupt handling (an interrupt entry, or the timer
+        # setting its IS bit) just before an instruction that failed. Bit 2
+        # means the PC was 256, past the end of RAM, which only such a
+        # record can have.
+        self.chunks = deque()
+        # Steps in each chunk, not counting records with bit 1 set
+        self.chunk_counts = deque()
+        # Step number (cycle count) the oldest record undoes back to
+        self.first_step = cpu.cycles
+
+        # (step, Snapshot) pairs, oldest first
+        self.checkpoints = deque()
+        self.checkpoints.append((cpu.cycles, cpu.snapshot()))
+
+        # RAM writes made by the instruction being executed
+        self.writes = []
+
+        cpu.journal = self
+        # Route RAM writes through the journal while it is attached, on to
+        # whatever handled them before (e.g. a devices.Bus)
+        self.saved_write = vars(cpu).get('ram_write')
+        self.next_write = cpu.ram_write
+        cpu.ram_write = self.ram_write
+
+    def detach(self):
+        # Stop journaling and go back to the normal run() loop
+        self.cpu.journal = None
+        if self.saved_write is not None:
+            self.cpu.ram_write = self.saved_write
+        else:
+            del self.cpu.ram_write
+
+    def ram_write(self, mdr, mar):
+        # Remember the old byte, then write as usual
+        if 0 <= mar < len(self.cpu.ram):
+            self.writes.append(mar)
+            self.writes.append(self.cpu.ram[mar])
+        self.next_write(mdr, mar)
+
+    @property
+    def steps(self):
+        """How many instructions can currently be undone."""
+        return sum(self.chunk_counts)
+
+    def interpret(self):
+        """
+        The same loop as CPU.interpret(), recording an undo record for each
+        instruction. Interrupt entry is recorded with the instruction that
+        follows it, or on its own if that instruction fails.
+        """
+        cpu = self.cpu
+        reg = cpu.reg
+        decoded = cpu.decoded
+        writes = self.writes
+
+        while True:
+            writes.clear()
+            pc = cpu.pc
+            fl = cpu.fl
+            interrupts_enabled = cpu.interrupts_enabled
+            before = bytes(reg)
+
+            if cpu.cycles >= cpu.deadline:
+                if cpu.cycles >= cpu.cycle_limit:
+                    return
+                cpu.check_interrupts()
+
+            try:
+                entry = decoded[cpu.pc]
+                if entry is None:
+                    entry = cpu.decode(cpu.pc)
+                handler, operands, next_pc = entry
+
+                handler(*operands)
+            except Halt:
+                # run() counts the HLT cycle; record it so it can be undone
+                self.record(pc, fl, interrupts_enabled, before)
+                raise
+            except CPUError:
+                # The instruction didn't run, so no cycle is counted, but
+                # check_interrupts() just before it may have changed things
+                # that need undoing
+                if bytes(reg) != before or writes or \
+                        cpu.interrupts_enabled != interrupts_enabled:
+                    self.record(pc, fl, interrupts_enabled, before, False)
+                raise
+            if next_pc is not None:
+                cpu.pc = next_pc
+            cpu.cycles += 1
+
+            self.record(pc, fl, interrupts_enabled, before)
+
+            if cpu.cycles % self.checkpoint_interval == 0:
+                self.checkpoint()
+
+    def record(self, pc, fl, interrupts_enabled, before, counted=True):
+        # Append the undo record for the step that just ran. counted is
+        # False for an interrupt entry with no instruction after it.
+        reg = self.cpu.reg
+        mask = 0
+        old_values = []
+        if reg != before:
+            for i in range(8):
+                if reg[i] != before[i]:
+                    mask |= 1 << i
+                    old_values.append(before[i])
+
+        flags = int(interrupts_enabled) | (0 if counted else 2)
+        if pc > 0xFF:
+            flags |= 4
+        payload = bytes([pc & 0xFF, fl, flags, mask]) + \
+            bytes(old_values) + bytes(self.writes)
+
+        if not self.chunks or self.chunk_counts[-1] == CHUNK_STEPS:
+            self.chunks.append(bytearray())
+            self.chunk_counts.append(0)
+            self.trim()
+
+        chunk = self.chunks[-1]
+        chunk += payload
+        chunk.append(len(payload))
+        if counted:
+            self.chunk_counts[-1] += 1
+
+    def trim(self):
+        # Drop the oldest chunks while more than capacity steps are held
+        while len(self.chunks) > 1 and \
+                self.steps - self.chunk_counts[0] >= self.capacity:
+            self.chunks.popleft()
+            self.first_step += self.chunk_counts.popleft()
+
+    def checkpoint(self):
+        self.checkpoints.append((self.cpu.cycles, self.cpu.snapshot()))
+
+        if len(self.checkpoints) > MAX_CHECKPOINTS:
+            # Keep every other one (including the first) and take them half
+            # as often from now on, so they still cover the whole run
+            self.checkpoints = deque(list(self.checkpoints)[::2])
+            self.checkpoint_interval *= 2
+
+    def records(self):
+        """
+        Yield (step, pc, ram_writes) for each record, newest first, where
+        ram_writes is a list of (address, old byte) pairs. A record of an
+        interrupt entry whose instruction failed has the same step as the
+        record after it.
+        """
+        step = self.first_step + self.steps
+        for chunk in reversed(self.chunks):
+            end = len(chunk)
+            while end > 0:
+                length = chunk[end - 1]
+                start = end - 1 - length
+                payload = chunk[start:end - 1]
+                if not payload[2] & 2:
+                    step -= 1
+                changed = bin(payload[3]).count("1")
+                pairs = payload[4 + changed:]
+                pc = payload[0] + (256 if payload[2] & 4 else 0)
+                yield step, pc, list(zip(pairs[0::2], pairs[1::2]))
+                end = start
+
+    def pop_record(self):
+        # Remove and return the newest record's payload
+        while self.chunks and not self.chunks[-1]:
+            self.chunks.pop()
+            self.chunk_counts.pop()
+        if not self.chunks:
+            return None
+
+        chunk = self.chunks[-1]
+        length = chunk[-1]
+        start = len(chunk) - 1 - length
+        payload = bytes(chunk[start:-1])
+        del chunk[start:]
+        if not payload[2] & 2:
+            self.chunk_counts[-1] -= 1
+        return payload
+
+    def step_back(self, count=1):
+        """
+        Undo up to count instructions. Returns how many were undone. An
+        interrupt entry whose instruction failed is undone along the way
+        without counting as one.
+        """
+        cpu = self.cpu
+        undone = 0
+
+        while undone < count:
+            payload = self.pop_record()
+            if payload is None:
+                break
+
+            pc, fl, flags, mask = payload[:4]
+            position = 4
+            for i in range(8):
+                if mask & (1 << i):
+                    cpu.reg[i] = payload[position]
+                    position += 1
+
+            # Undo RAM writes newest first
+            pairs = payload[position:]
+            for i in range(len(pairs) - 2, -1, -2):
+                CPU.ram_write(cpu, pairs[i + 1], pairs[i])
+
+            cpu.pc = pc + (256 if flags & 4 else 0)
+            cpu.fl = fl
+            cpu.interrupts_enabled = bool(flags & 1)
+            if not flags & 2:
+                cpu.cycles -= 1
+                undone += 1
+
+        # Re-check interrupts before the next instruction
+        cpu.deadline = 0
+        return undone
+
+    def run_back_to(self, pc):
+        """
+        Undo instructions until the PC is pc again. Returns True if it got
+        there, False if the journal ran out first.
+        """
+        while self.step_back():
+            if self.cpu.pc == pc:
+                return True
+        return False
+
+    def last_writer(self, address):
+        """
+        (step, pc) of the last recorded instruction that wrote address, or
+        None. step is the cycle count just before that instruction ran.
+        """
+        for step, pc, ram_writes in self.records():
+            for written, _ in ram_writes:
+                if written == address:
+                    return step, pc
+        return None
+
+    def seek(self, step):
+        """
+        Put the CPU in the state it had after `step` instructions. Steps
+        still in the journal are undone; older ones are reached by restoring
+        the nearest earlier checkpoint and running forward, which replays the
+        same instructions (timer and keyboard input may arrive differently).
+        """
+        cpu = self.cpu
+
+        if step >= cpu.cycles:
+            raise ValueError("can only seek backwards")
+
+        if step >= self.first_step:
+            self.step_back(cpu.cycles - step)
+            return
+
+        for checkpoint_step, snapshot in reversed(self.checkpoints):
+            if checkpoint_step <= step:
+                break
+        else:
+            raise ValueError("no checkpoint before step " + str(step))
+
+        # Output isn't rewound, here or by step_back()
+        cpu.restore(snapshot._replace(output=None))
+        self.chunks.clear()
+        self.chunk_counts.clear()
+        self.first_step = checkpoint_step
+        while self.checkpoints[-1][0] > checkpoint_step:
+            self.checkpoints.pop()
+
+        # The replay shouldn't print again what was printed the first time
+        saved_output = cpu.output
+        cpu.output = NullSink()
+        try:
+            cpu.run(step - checkpoint_step)
+        finally:
+            cpu.output = saved_output
@@ -0,0 +1,104 @@
+"""
+Keyboard input for the LS-8, as the spec describes it: each key is written to
+address 0xF4 and sets bit 1 of IS, so a program like keyboard.ls8 takes one
+keyboard interrupt per key.
+
+    cpu = CPU()
+    cpu.load('examples/keyboard.ls8')
+    KeyboardInput(cpu, b"scripted keys")   # or KeyboardInput(cpu) for stdin
+    cpu.run(max_cycles=100000)
+
+Keys read from stdin arrive on a background thread, so the CPU never waits
+for them. Nothing happens per instruction: the CPU only looks for keys when
+it checks its interrupts (see CPU.pollers), and the thread brings that check
+forward when a key arrives.
+
+A key is held back until the program has dealt with the one before it, that
+is until bit 1 of IS is clear and no interrupt handler is running.
+"""
+
+import os
+import sys
+import threading
+from collections import deque
+
+from cpu import *
+from devices import KEYBOARD_ADDRESS, KEYBOARD_INTERRUPT
+
+
+class KeyboardInput:
+    """Feeds keys from stdin, or from a fixed byte string, to a CPU."""
+
+    def __init__(self, cpu, keys=None, file=None):
+        """
+        With keys (bytes or a str) those are typed in order. Otherwise keys
+        are read from file (a file object with a fileno(), default stdin)
+        on a background thread.
+        """
+        self.cpu = cpu
+        # deque appends and pops are safe between threads
+        self.keys = deque()
+        self.thread = None
+        self.saved_mode = None
+
+        if keys is not None:
+            if isinstance(keys, str):
+                keys = keys.encode()
+            self.keys.extend(keys)
+        else:
+            self.start(sys.stdin if file is None else file)
+
+        cpu.pollers.append(self.poll)
+
+    def start(self, file):
+        fd = file.fileno()
+
+        if os.isatty(fd):
+            # Send keys as they are typed, not a line at a time
+            try:
+                import termios
+                import tty
+                self.saved_mode = (fd, termios.tcgetattr(fd))
+                tty.setcbreak(fd)
+            except (ImportError, OSError):
+                self.saved_mode = None
+
+        self.thread = threading.Thread(target=self.read, args=(fd,),
+                                       daemon=True)
+        self.thread.start()
+
+    def read(self, fd):
+        # Background thread: queue bytes until end of file
+        while True:
+            try:
+                data = os.read(fd, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            self.keys.extend(data)
+            # Have the CPU check for them before its next instruction
+            self.cpu.deadline = 0
+
+    def poll(self):
+        # Called from CPU.check_interrupts()
+        cpu = self.cpu
+        if not self.keys or not cpu.interrupts_enabled:
+            return
+        if cpu.reg[6] & (1 << KEYBOARD_INTERRUPT):
+            # The last key hasn't been taken yet
+            return
+
+        cpu.ram_write(self.keys.popleft(), KEYBOARD_ADDRESS)
+        cpu.reg[6] |= 1 << KEYBOARD_INTERRUPT
+
+    def close(self):
+        """Stop delivering keys and put the terminal back as it was."""
+        if self.poll in self.cpu.pollers:
+            self.cpu.pollers.remove(self.poll)
+
+        if self.saved_mode is not None:
+            import termios
+            fd, mode = self.saved_mode
+            termios.tcsetattr(fd, termios.TCSADRAIN, mode)
+            self.saved_mode = None
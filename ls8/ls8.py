@@ -1,16 +1,176 @@
 #!/usr/bin/env python3
-import curses
 
 """Main."""
 
+import argparse
+import os
 import sys
 from cpu import *
+from output import FileSink, NullSink
+
+
+def address(text):
+    # A RAM address in hex, the way the spec writes them (e.g. E0)
+    value = int(text, 16)
+    if not 0 <= value <= 0xFF:
+        raise ValueError(text)
+    return value
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(description="Run an LS-8 program.")
+    parser.add_argument('program', nargs='?',
+                        help=".ls8, .asm or .bin file or .ls8b image to run "
+                        "(defaults to a built-in print8 program)")
+    parser.add_argument('--jit', action='store_true',
+                        help="use the basic-block compiler instead of "
+                        "the interpreter")
+    parser.add_argument('--max-cycles', type=int,
+                        help="stop after this many instructions")
+    parser.add_argument('--clock-hz', type=clock_rate, metavar='N',
+                        help="run the timer interrupt on a virtual clock of "
+                        "N instructions per second, instead of wall-clock "
+                        "time")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="write what the program prints to FILE")
+    parser.add_argument('--quiet', action='store_true',
+                        help="discard what the program prints")
+    parser.add_argument('--profile', action='store_true',
+                        help="print an execution profile to stderr at exit "
+                        "(uses the interpreter)")
+    parser.add_argument('--folded', metavar='FILE',
+                        help="with --profile, also write folded call stacks "
+                        "for a flamegraph to FILE")
+    parser.add_argument('--input', metavar='FILE',
+                        help="map the keyboard at F4 and feed it the bytes "
+                        "of FILE, one keyboard interrupt per byte")
+    parser.add_argument('--disk', metavar='FILE',
+                        help="map a block storage device backed by FILE "
+                        "at E0")
+    parser.add_argument('--disk-at', type=address, metavar='ADDR',
+                        help="map the disk at ADDR (in hex) instead of E0")
+    parser.add_argument('--devices', action='store_true',
+                        help="also map the console at F6 and the millisecond "
+                        "timer at E4")
+    parser.add_argument('--timer-at', type=address, metavar='ADDR',
+                        help="with --devices, map the timer at ADDR (in hex) "
+                        "instead of E4")
+    parser.add_argument('--keyboard', action='store_true',
+                        help="type keys from stdin: each one is stored at F4 "
+                        "and raises the keyboard interrupt")
+    parser.add_argument('--keys', metavar='TEXT',
+                        help="like --keyboard, but type TEXT instead")
+    args = parser.parse_args(argv[1:])
+
+    # Both would deliver keys at F4 with the same interrupt
+    if args.input is not None and (args.keyboard or args.keys is not None):
+        parser.error("--input can't be used with --keyboard or --keys")
+
+    return args
+
+
+def find_program(file_to_load):
+    # Look relative to the current directory first, then next to this script
+    if os.path.exists(file_to_load):
+        return file_to_load
+    return os.path.join(sys.path[0], file_to_load)
+
+
+def map_devices(cpu, args):
+    # Attach a device bus with the devices asked for on the command line
+    import devices
+
+    bus = devices.Bus(cpu)
+
+    if args.input is not None:
+        keyboard = devices.Keyboard(cpu)
+        bus.map(devices.KEYBOARD_ADDRESS, keyboard)
+        with open(args.input, 'rb') as f:
+            keyboard.feed(f.read())
+
+    if args.disk is not None:
+        disk_address = devices.DISK_ADDRESS
+        if args.disk_at is not None:
+            disk_address = args.disk_at
+        bus.map(disk_address, devices.BlockStorage(args.disk))
+
+    if args.devices:
+        timer_address = devices.TIMER_ADDRESS
+        if args.timer_at is not None:
+            timer_address = args.timer_at
+        bus.map(devices.CONSOLE_ADDRESS, devices.Console(cpu))
+        bus.map(timer_address, devices.Timer())
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    if args.quiet:
+        output = NullSink()
+    elif args.output is not None:
+        output = FileSink(args.output)
+    else:
+        output = None
+
+    cpu = CPU(output=output, clock_hz=args.clock_hz)
+
+    try:
+        if args.program is None:
+            cpu.load()
+        else:
+            cpu.load(find_program(args.program))
+    except CPUError as e:
+        print(e)
+        return 1
+
+    if args.input is not None or args.disk is not None or args.devices:
+        try:
+            map_devices(cpu, args)
+        except CPUError as e:
+            # Devices that overlap, or don't fit in RAM
+            print(e)
+            return 1
+
+    keyboard = None
+    if args.keyboard or args.keys is not None:
+        from keyboard import KeyboardInput
+        keyboard = KeyboardInput(cpu, args.keys)
+
+    profiler = None
+    if args.profile:
+        from profiler import Profiler
+        profiler = Profiler(cpu)
+
+    try:
+        if args.jit:
+            if profiler is None:
+                # Compile the program's basic blocks before it starts
+                from analyze import warm
+                warm(cpu, jit=True)
+            # With a profiler attached this uses the interpreter
+            result = cpu.run_jit(args.max_cycles)
+        else:
+            result = cpu.run(args.max_cycles)
+    finally:
+        if keyboard is not None:
+            # Put the terminal back, even after Ctrl-C
+            keyboard.close()
+
+    if profiler is not None:
+        profiler.report()
+        if args.folded is not None:
+            profiler.write_folded(args.folded)
+
+    if result.reason == ERROR:
+        print(result.error)
+        return 1
+
+    if result.reason == MAX_CYCLES:
+        print(f"Stopped after {result.cycles} cycles", file=sys.stderr)
+        return 2
+
+    return 0
 
-cpu = CPU()
 
-cpu.load()
-cpu.run()
-'''
 if __name__ == '__main__':
-    curses.wrapper(cpu.run)
-'''
+    sys.exit(main(sys.argv))
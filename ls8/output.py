@@ -0,0 +1,117 @@
+"""
+Output devices for PRN and PRA.
+
+Every sink has write(text) and flush(). write() only collects text; the CPU
+calls flush() when the program halts, when an interrupt handler is entered or
+returns, and when run() returns, so a program that prints one character at a
+time doesn't cost a print() call or a terminal write per character.
+"""
+
+import sys
+
+# Buffered sinks flush on their own once this many pieces are waiting
+FLUSH_THRESHOLD = 1024
+
+
+class Sink:
+    """Base class: discards everything."""
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        # Only sinks that keep their output in memory return it
+        return None
+
+
+class NullSink(Sink):
+    """Throws all output away."""
+
+
+class FileSink(Sink):
+    """
+    Buffers output and writes it to a file object (or a path, which is opened
+    for writing) on flush.
+    """
+
+    def __init__(self, file):
+        if isinstance(file, str):
+            file = open(file, "w")
+        self.file = file
+        self.parts = []
+
+    def write(self, text):
+        parts = self.parts
+        parts.append(text)
+        if len(parts) >= FLUSH_THRESHOLD:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            self.file.write(''.join(self.parts))
+            self.parts.clear()
+        self.file.flush()
+
+    def getvalue(self):
+        # Works when the file is an io.StringIO
+        getvalue = getattr(self.file, 'getvalue', None)
+        if getvalue is None:
+            return None
+        self.flush()
+        return getvalue()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class StdoutSink(FileSink):
+    """
+    Buffers output for sys.stdout. sys.stdout is looked up at each flush, so
+    redirecting it afterwards still works.
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    @property
+    def file(self):
+        return sys.stdout
+
+    def getvalue(self):
+        return None
+
+
+class MemorySink(Sink):
+    """Keeps all output in memory; getvalue() returns it as one string."""
+
+    def __init__(self, text=''):
+        self.parts = [text] if text else []
+
+    def reset(self, text=''):
+        # Replace everything written so far with text
+        self.parts[:] = [text] if text else []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def getvalue(self):
+        if len(self.parts) > 1:
+            # Join once, so repeated calls stay cheap
+            self.parts[:] = [''.join(self.parts)]
+        return self.parts[0] if self.parts else ''
+
+
+def make_sink(output):
+    """
+    The sink for CPU(output=...): None means buffered stdout, a Sink is used
+    as is, and any other file object is wrapped in a FileSink.
+    """
+    if output is None:
+        return StdoutSink()
+    if isinstance(output, Sink):
+        return output
+    return FileSink(output)
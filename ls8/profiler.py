@@ -0,0 +1,178 @@
+"""
+Execution profiler for the LS-8 CPU.
+
+Attach a Profiler to a CPU and run() uses a counting copy of its loop instead
+of the normal one, so there is no cost when no profiler is attached:
+
+    cpu = CPU()
+    cpu.load('examples/call.ls8')
+    profiler = Profiler(cpu)
+    cpu.run()
+    profiler.report()
+    profiler.write_folded('call.folded')
+
+The folded file has one "frame;frame;frame count" line per call stack, with
+the count in instructions, which is the input flamegraph.pl and speedscope
+expect. The outermost frame is "main"; subroutines are named after the
+address they start at (sub_1A), and interrupt handlers likewise (irq_11).
+"""
+
+import sys
+import time
+from collections import Counter
+
+from cpu import *
+from jit import BLOCK_ENDS
+
+
+class Frame:
+    """One entry of the profiled call stack."""
+
+    def __init__(self, name, stack, started, cycles):
+        self.name = name
+        # Folded stack key, e.g. "main;sub_1A"
+        self.stack = stack
+        self.started = started
+        self.cycles = cycles
+
+
+class Profiler:
+    """Counts what a CPU executes while it runs."""
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        cpu.profiler = self
+
+        # Executions per opcode, per PC address and per basic block start
+        self.opcodes = Counter()
+        self.addresses = Counter()
+        self.blocks = Counter()
+
+        # Per CALL target (and interrupt handler): calls, inclusive
+        # instruction count and inclusive time in seconds
+        self.calls = Counter()
+        self.call_cycles = Counter()
+        self.call_seconds = Counter()
+
+        # Instructions executed per folded call stack
+        self.folded = Counter()
+
+        self.frames = [Frame("main", "main", time.perf_counter(), cpu.cycles)]
+
+    def detach(self):
+        # Go back to running without the profiler
+        self.cpu.profiler = None
+
+    def enter(self, name):
+        # Push a frame for a CALL or an interrupt
+        top = self.frames[-1]
+        self.frames.append(Frame(name, top.stack + ";" + name,
+                                 time.perf_counter(), self.cpu.cycles))
+        self.calls[name] += 1
+
+    def leave(self):
+        # Pop the frame for a RET or an IRET
+        if len(self.frames) == 1:
+            # Returning from something we didn't see called
+            return
+        frame = self.frames.pop()
+        self.call_cycles[frame.name] += self.cpu.cycles - frame.cycles
+        self.call_seconds[frame.name] += time.perf_counter() - frame.started
+
+    def interpret(self):
+        """
+        The same loop as CPU.interpret(), recording each instruction.
+        """
+        cpu = self.cpu
+        ram = cpu.ram
+        decoded = cpu.decoded
+        opcodes = self.opcodes
+        addresses = self.addresses
+        blocks = self.blocks
+        folded = self.folded
+
+        new_block = True
+
+        while True:
+            if cpu.cycles >= cpu.deadline:
+                if cpu.cycles >= cpu.cycle_limit:
+                    return
+                pc = cpu.pc
+                cpu.check_interrupts()
+                if cpu.pc != pc:
+                    # An interrupt handler was entered
+                    self.enter(f"irq_{cpu.pc:02X}")
+                    new_block = True
+
+            pc = cpu.pc
+            entry = decoded[pc]
+            if entry is None:
+                entry = cpu.decode(pc)
+            handler, operands, next_pc = entry
+
+            ir = ram[pc]
+            opcodes[ir] += 1
+            addresses[pc] += 1
+            if new_block:
+                blocks[pc] += 1
+            folded[self.frames[-1].stack] += 1
+
+            handler(*operands)
+            if next_pc is not None:
+                cpu.pc = next_pc
+            cpu.cycles += 1
+
+            new_block = ir in BLOCK_ENDS
+            if ir == CALL:
+                self.enter(f"sub_{cpu.pc:02X}")
+            elif ir == RET or ir == IRET:
+                self.leave()
+
+    def report(self, file=None, top=10):
+        """Print a summary of where the cycles went."""
+        if file is None:
+            file = sys.stderr
+
+        total = sum(self.opcodes.values())
+        print(f"Profile: {total} instructions", file=file)
+
+        print("\nBy opcode:", file=file)
+        for ir, count in self.opcodes.most_common(top):
+            print(f"  {self.opcode_name(ir):<6} {count:>10} "
+                  f"{percent(count, total):>6}", file=file)
+
+        print("\nHottest addresses:", file=file)
+        for pc, count in self.addresses.most_common(top):
+            print(f"  {pc:02X}     {count:>10} {percent(count, total):>6}",
+                  file=file)
+
+        print("\nHottest basic blocks (by entries):", file=file)
+        for pc, count in self.blocks.most_common(top):
+            print(f"  {pc:02X}     {count:>10}", file=file)
+
+        if self.calls:
+            print("\nSubroutines (inclusive):", file=file)
+            print(f"  {'name':<8} {'calls':>8} {'instructions':>12} "
+                  f"{'seconds':>9}", file=file)
+            for name, cycles in self.call_cycles.most_common(top):
+                print(f"  {name:<8} {self.calls[name]:>8} {cycles:>12} "
+                      f"{self.call_seconds[name]:>9.4f}", file=file)
+
+    def opcode_name(self, ir):
+        # handle_ADD -> ADD
+        handler = self.cpu.ops.get(ir)
+        if handler is None:
+            return f"{ir:02X}"
+        return handler.__name__.replace("handle_", "")
+
+    def write_folded(self, path):
+        """Write the folded call stacks for a flamegraph."""
+        with open(path, "w") as f:
+            for stack, count in sorted(self.folded.items()):
+                f.write(f"{stack} {count}\n")
+
+
+def percent(count, total):
+    if not total:
+        return ""
+    return f"{100 * count / total:.1f}%"
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+Run many LS-8 sessions cooperatively on one asyncio event loop.
+
+Each session's CPU runs for a slice of instructions at a time (CPU.run with
+max_cycles), then yields to the other sessions. What a program prints
+arrives on the session's output queue, and bytes put on its input queue are
+typed on its keyboard (see keyboard.py):
+
+    async def main():
+        scheduler = Scheduler()
+        session = scheduler.add(Session('examples/keyboard.ls8', quota=10**6))
+        session.send(b"hi")
+        run = asyncio.create_task(scheduler.run())
+        while (text := await session.output.get()) is not None:
+            print(text, end='')
+        await run
+
+A session stops when its program halts, hits an error or uses up its cycle
+quota. None is put on its output queue when it stops, and session.result
+holds its RunResult.
+"""
+
+import argparse
+import asyncio
+import sys
+
+from cpu import *
+from keyboard import KeyboardInput
+from output import Sink
+
+# Instructions a session runs before yielding to the others
+SLICE_CYCLES = 10000
+
+# Extra reason reported when a session uses up its quota
+QUOTA = 'quota'
+
+
+class QueueSink(Sink):
+    """
+    Buffers output and puts it on an asyncio.Queue, one string per flush.
+    The CPU flushes whenever run() returns, so each slice's output is
+    delivered when the slice ends.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def flush(self):
+        if self.parts:
+            self.queue.put_nowait(''.join(self.parts))
+            self.parts.clear()
+
+
+class Session:
+    """One CPU with its own output and input queues."""
+
+    def __init__(self, program, name=None, quota=None, clock_hz=None):
+        """
+        program is anything CPU.load() accepts. quota is the most
+        instructions the session may run in total (None for no limit).
+        Raises CPUError if the program can't be loaded.
+        """
+        self.name = program if name is None and isinstance(program, str) \
+            else name
+        self.quota = quota
+
+        self.output = asyncio.Queue()
+        self.input = asyncio.Queue()
+
+        self.cpu = CPU(output=QueueSink(self.output), clock_hz=clock_hz)
+        self.cpu.load(program)
+        self.keyboard = KeyboardInput(self.cpu, b"")
+
+        self.result = None
+
+    def send(self, data):
+        """Queue keyboard input (bytes or a str)."""
+        self.input.put_nowait(data)
+
+    async def pump_input(self):
+        # Move input from the queue to the keyboard as it arrives
+        while True:
+            data = await self.input.get()
+            if isinstance(data, str):
+                data = data.encode()
+            self.keyboard.keys.extend(data)
+            # Have the CPU look for it before its next instruction
+            self.cpu.deadline = 0
+
+
+class Scheduler:
+    """Round-robins sessions in slices of slice_cycles instructions."""
+
+    def __init__(self, slice_cycles=SLICE_CYCLES):
+        self.slice_cycles = slice_cycles
+        self.sessions = []
+
+    def add(self, session):
+        """Add a session; it starts running with the next run()."""
+        self.sessions.append(session)
+        return session
+
+    async def run_session(self, session):
+        """Run one session until it stops. Returns its RunResult."""
+        cpu = session.cpu
+        pump = asyncio.create_task(session.pump_input())
+
+        try:
+            while True:
+                budget = self.slice_cycles
+                if session.quota is not None:
+                    budget = min(budget, session.quota - cpu.cycles)
+                    if budget <= 0:
+                        result = RunResult(QUOTA, cpu.cycles, None, None)
+                        break
+
+                result = cpu.run(budget)
+                if result.reason != MAX_CYCLES:
+                    break
+
+                # Let the other sessions (and the input pumps) run
+                await asyncio.sleep(0)
+        finally:
+            pump.cancel()
+            session.output.put_nowait(None)
+
+        session.result = result
+        return result
+
+    async def run(self):
+        """Run every session to completion. Returns their RunResults."""
+        return await asyncio.gather(
+            *(self.run_session(session) for session in self.sessions))
+
+
+async def print_output(session):
+    # Copy a session's output to stdout, prefixed with its name
+    while True:
+        text = await session.output.get()
+        if text is None:
+            return
+        for line in text.splitlines(keepends=True):
+            sys.stdout.write(f"[{session.name}] {line}")
+            if not line.endswith("\n"):
+                sys.stdout.write("\n")
+
+
+async def run_all(args):
+    scheduler = Scheduler(args.slice)
+
+    for program in args.programs:
+        session = scheduler.add(Session(program, quota=args.quota,
+                                        clock_hz=args.clock_hz))
+        if args.keys is not None:
+            session.send(args.keys)
+
+    printers = [asyncio.create_task(print_output(session))
+                for session in scheduler.sessions]
+    results = await scheduler.run()
+    await asyncio.gather(*printers)
+
+    for session, result in zip(scheduler.sessions, results):
+        message = f"{session.name}: {result.reason} after {result.cycles} cycles"
+        if result.error is not None:
+            message += f" ({result.error})"
+        print(message, file=sys.stderr)
+
+
+def parse_commandline(argv):
+    parser = argparse.ArgumentParser(
+        description="Run LS-8 programs side by side on one event loop.")
+    parser.add_argument('programs', nargs='+',
+                        help="programs to run, one session each")
+    parser.add_argument('--slice', type=int, default=SLICE_CYCLES,
+                        help="instructions per slice")
+    parser.add_argument('--quota', type=int,
+                        help="instruction limit per session")
+    parser.add_argument('--clock-hz', type=clock_rate, metavar='N',
+                        help="run timer interrupts on a virtual clock of N "
+                        "instructions per second")
+    parser.add_argument('--keys', metavar='TEXT',
+                        help="type TEXT on every session's keyboard")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    args = parse_commandline(argv)
+
+    try:
+        asyncio.run(run_all(args))
+    except CPUError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
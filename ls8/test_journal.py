@@ -0,0 +1,49 @@
+"""
+Regression tests for journal.py. Run from this directory with
+
+    python -m unittest test_journal
+"""
+
+import unittest
+
+from cpu import *
+from journal import Journal
+from output import NullSink
+
+
+def state(cpu):
+    # Everything step_back() should put back
+    return (cpu.pc, cpu.fl, cpu.cycles, cpu.interrupts_enabled,
+            bytes(cpu.reg), bytes(cpu.ram))
+
+
+class StepBackTest(unittest.TestCase):
+
+    def run_and_undo(self, program, clock_hz):
+        # Run to the error, check the timer fired, then undo everything
+        cpu = CPU(output=NullSink(), clock_hz=clock_hz)
+        cpu.load_bytes(program)
+        initial = state(cpu)
+        journal = Journal(cpu)
+
+        result = cpu.run(10000)
+        self.assertEqual(result.reason, ERROR)
+        self.assertEqual(cpu.reg[6] & 1, 1)
+
+        journal.step_back(10 ** 9)
+        self.assertEqual(state(cpu), initial)
+
+    def test_timer_fires_just_before_failing_instruction(self):
+        # Interrupts are masked, so the tick only sets bit 0 of IS (R6),
+        # right before the DIV by zero
+        program = bytes([LDI, 0, 1, LDI, 1, 0, DIV, 0, 1])
+        self.run_and_undo(program, 2)
+
+    def test_timer_fires_as_pc_runs_off_the_end(self):
+        # 86 instructions fill RAM, so the tick comes with the PC at 256
+        program = bytes([LDI, 0, 0] * 84 + [PRN, 0, PRN, 0])
+        self.run_and_undo(program, 86)
+
+
+if __name__ == "__main__":
+    unittest.main()
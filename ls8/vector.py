@@ -0,0 +1,345 @@
+"""
+Lockstep execution of many LS-8 machines at once with NumPy.
+
+VectorCPU keeps N machine states as arrays (N x 8 registers, N x 256 bytes of
+RAM, N PCs and flags) and executes one instruction on every running lane per
+step(). Lanes are grouped by the opcode they are about to execute, and each
+group is handled with whole-array operations, so lanes are free to take
+different paths through the program.
+
+This module needs NumPy, which the rest of the emulator does not. Timer and
+keyboard interrupts are not modelled here: IRET stops a lane with an error.
+"""
+
+import numpy as np
+
+from cpu import *
+from image import load_program
+
+
+class VectorCPU:
+    """N independent LS-8 machines stepped together."""
+
+    def __init__(self, lanes, program=None):
+        self.lanes = lanes
+
+        self.reg = np.zeros((lanes, 8), dtype=np.uint8)
+        # SP starts at F4 on every lane
+        self.reg[:, 7] = 0xF4
+        self.ram = np.zeros((lanes, 256), dtype=np.uint8)
+        self.pc = np.zeros(lanes, dtype=np.int32)
+        self.fl = np.zeros(lanes, dtype=np.uint8)
+        self.cycles = np.zeros(lanes, dtype=np.int64)
+
+        # Lanes that have halted or hit an error
+        self.stopped = np.zeros(lanes, dtype=bool)
+        self.reasons = [None] * lanes
+        self.errors = [None] * lanes
+        self.output = [[] for _ in range(lanes)]
+
+        # opcode -> handler(lanes, operand_a, operand_b)
+        self.ops = {
+            LDI: self.handle_LDI,
+            LD: self.handle_LD,
+            ST: self.handle_ST,
+            PRN: self.handle_PRN,
+            PRA: self.handle_PRA,
+            HLT: self.handle_HLT,
+            PUSH: self.handle_PUSH,
+            POP: self.handle_POP,
+            CALL: self.handle_CALL,
+            RET: self.handle_RET,
+            JMP: self.handle_JMP,
+            JEQ: self.handle_JEQ,
+            JNE: self.handle_JNE,
+            JLT: self.handle_JLT,
+            JLE: self.handle_JLE,
+            JGT: self.handle_JGT,
+            JGE: self.handle_JGE,
+            IRET: self.handle_IRET,
+            ADD: self.handle_ADD,
+            SUB: self.handle_SUB,
+            MUL: self.handle_MUL,
+            DIV: self.handle_DIV,
+            MOD: self.handle_MOD,
+            AND: self.handle_AND,
+            OR: self.handle_OR,
+            XOR: self.handle_XOR,
+            SHL: self.handle_SHL,
+            SHR: self.handle_SHR,
+            NOT: self.handle_NOT,
+            INC: self.handle_INC,
+            DEC: self.handle_DEC,
+            CMP: self.handle_CMP,
+            ADDI: self.handle_ADDI,
+        }
+
+        if program is not None:
+            self.load(program)
+
+    def load(self, program):
+        """Copy the same program (bytes, or a .ls8/.ls8b path) into every lane."""
+        if isinstance(program, str):
+            try:
+                program = load_program(program)
+            except ValueError as e:
+                raise CPUError(str(e))
+        if len(program) > 256:
+            raise CPUError("Program is too large: " +
+                           str(len(program)) + " bytes")
+        self.ram[:, :len(program)] = np.frombuffer(bytes(program),
+                                                   dtype=np.uint8)
+
+    def stop(self, lanes, reason, error=None):
+        # Take lanes out of the running set
+        self.stopped[lanes] = True
+        for lane in lanes.tolist():
+            self.reasons[lane] = reason
+            self.errors[lane] = error
+
+    def step(self):
+        """
+        Execute one instruction on every lane that is still running. Returns
+        the number of lanes that executed an instruction.
+        """
+        active = np.flatnonzero(~self.stopped)
+        if len(active) == 0:
+            return 0
+
+        pc = self.pc[active]
+
+        # A lane whose PC ran off the end of RAM can't fetch
+        bad = pc > 255
+        if bad.any():
+            for lane, address in zip(active[bad].tolist(), pc[bad].tolist()):
+                self.stop(np.array([lane]), ERROR,
+                          "MAR is too high: " + str(address))
+            active = active[~bad]
+            pc = pc[~bad]
+
+        ir = self.ram[active, pc]
+        # Operands; a fetch past the end of RAM is caught below
+        operand_a = self.ram[active, np.minimum(pc + 1, 255)]
+        operand_b = self.ram[active, np.minimum(pc + 2, 255)]
+
+        for op in np.unique(ir).tolist():
+            group = ir == op
+            lanes = active[group]
+            a = operand_a[group]
+            b = operand_b[group]
+
+            handler = self.ops.get(op)
+            if handler is None:
+                for lane, address in zip(lanes.tolist(), pc[group].tolist()):
+                    self.stop(np.array([lane]), ERROR,
+                              "Unknown instruction " + str(op) +
+                              " at " + str(address))
+                continue
+
+            num_operands = (op & 0b11000000) >> 6
+
+            # Same checks as CPU.decode(): the operands must be in RAM and
+            # every operand but an immediate must name a register
+            bad = pc[group] + num_operands > 255
+            if op in (LDI, ADDI):
+                bad |= a > 7
+            elif num_operands == 2:
+                bad |= (a > 7) | (b > 7)
+            elif num_operands == 1:
+                bad |= a > 7
+            if bad.any():
+                for lane, address in zip(lanes[bad].tolist(),
+                                         pc[group][bad].tolist()):
+                    self.stop(np.array([lane]), ERROR,
+                              "Invalid instruction at " + str(address))
+                lanes = lanes[~bad]
+                a = a[~bad]
+                b = b[~bad]
+                if len(lanes) == 0:
+                    continue
+
+            handler(lanes, a, b)
+
+            if op == HLT:
+                # Halted lanes count the HLT and keep their PC on it
+                self.cycles[lanes] += 1
+                continue
+
+            # Lanes that hit an error in the handler stay where they are
+            lanes = lanes[~self.stopped[lanes]]
+            self.cycles[lanes] += 1
+
+            # Advance the PC unless the instruction sets it itself
+            if not op & 0b00010000:
+                self.pc[lanes] += 1 + num_operands
+
+        return len(active)
+
+    def run(self, max_steps=None):
+        """
+        Step until every lane has stopped or max_steps steps have run.
+        Returns a RunResult per lane.
+        """
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if self.step() == 0:
+                break
+            steps += 1
+
+        return self.results()
+
+    def results(self):
+        """A RunResult per lane, like CPU.run() returns."""
+        results = []
+        for lane in range(self.lanes):
+            reason = self.reasons[lane] or MAX_CYCLES
+            results.append(RunResult(reason, int(self.cycles[lane]),
+                                     ''.join(self.output[lane]),
+                                     self.errors[lane]))
+        return results
+
+    # Helpers
+
+    def regs(self, lanes, registers):
+        # Register values as wide ints, so arithmetic can't overflow
+        return self.reg[lanes, registers].astype(np.int32)
+
+    def set_regs(self, lanes, registers, values):
+        self.reg[lanes, registers] = values & 0xFF
+
+    def jump_if(self, lanes, a, condition):
+        # Jump to the address in register a where condition holds
+        self.pc[lanes] = np.where(condition, self.reg[lanes, a],
+                                  self.pc[lanes] + 2)
+
+    # Instructions that don't use the ALU
+
+    def handle_LDI(self, lanes, a, b):
+        self.reg[lanes, a] = b
+
+    def handle_LD(self, lanes, a, b):
+        self.reg[lanes, a] = self.ram[lanes, self.reg[lanes, b]]
+
+    def handle_ST(self, lanes, a, b):
+        self.ram[lanes, self.reg[lanes, a]] = self.reg[lanes, b]
+
+    def handle_PRN(self, lanes, a, b):
+        for lane, value in zip(lanes.tolist(), self.reg[lanes, a].tolist()):
+            self.output[lane].append(str(value) + "\n")
+
+    def handle_PRA(self, lanes, a, b):
+        for lane, value in zip(lanes.tolist(), self.reg[lanes, a].tolist()):
+            self.output[lane].append(chr(value))
+
+    def handle_HLT(self, lanes, a, b):
+        self.stop(lanes, HALTED)
+
+    def handle_PUSH(self, lanes, a, b):
+        sp = (self.regs(lanes, 7) - 1) & 0xFF
+        self.reg[lanes, 7] = sp
+        self.ram[lanes, sp] = self.reg[lanes, a]
+
+    def handle_POP(self, lanes, a, b):
+        self.reg[lanes, a] = self.ram[lanes, self.reg[lanes, 7]]
+        self.set_regs(lanes, 7, self.regs(lanes, 7) + 1)
+
+    def handle_CALL(self, lanes, a, b):
+        sp = (self.regs(lanes, 7) - 1) & 0xFF
+        self.reg[lanes, 7] = sp
+        self.ram[lanes, sp] = (self.pc[lanes] + 2) & 0xFF
+        self.pc[lanes] = self.reg[lanes, a]
+
+    def handle_RET(self, lanes, a, b):
+        self.pc[lanes] = self.ram[lanes, self.reg[lanes, 7]]
+        self.set_regs(lanes, 7, self.regs(lanes, 7) + 1)
+
+    def handle_IRET(self, lanes, a, b):
+        self.stop(lanes, ERROR, "Interrupts are not supported by VectorCPU")
+
+    def handle_JMP(self, lanes, a, b):
+        self.pc[lanes] = self.reg[lanes, a]
+
+    def handle_JEQ(self, lanes, a, b):
+        self.jump_if(lanes, a, self.fl[lanes] & 0b001 != 0)
+
+    def handle_JNE(self, lanes, a, b):
+        self.jump_if(lanes, a, self.fl[lanes] & 0b001 == 0)
+
+    def handle_JLT(self, lanes, a, b):
+        self.jump_if(lanes, a, self.fl[lanes] >> 2 != 0)
+
+    def handle_JLE(self, lanes, a, b):
+        fl = self.fl[lanes]
+        self.jump_if(lanes, a, (fl >> 2 != 0) | (fl & 0b001 != 0))
+
+    def handle_JGT(self, lanes, a, b):
+        self.jump_if(lanes, a, self.fl[lanes] >> 1 == 1)
+
+    def handle_JGE(self, lanes, a, b):
+        fl = self.fl[lanes]
+        self.jump_if(lanes, a, (fl >> 1 == 1) | (fl & 0b001 != 0))
+
+    # ALU instructions
+
+    def handle_ADD(self, lanes, a, b):
+        self.set_regs(lanes, a, self.regs(lanes, a) + self.regs(lanes, b))
+
+    def handle_SUB(self, lanes, a, b):
+        self.set_regs(lanes, a, self.regs(lanes, a) - self.regs(lanes, b))
+
+    def handle_MUL(self, lanes, a, b):
+        self.set_regs(lanes, a, self.regs(lanes, a) * self.regs(lanes, b))
+
+    def divide(self, lanes, a, b, operation):
+        # DIV and MOD: lanes dividing by zero stop with an error and leave
+        # their registers alone, like CPU.handle_DIV()
+        divisor = self.regs(lanes, b)
+        zero = divisor == 0
+        if zero.any():
+            self.stop(lanes[zero], ERROR, "Division by 0 is not allowed.")
+            lanes = lanes[~zero]
+            a = a[~zero]
+            divisor = divisor[~zero]
+        self.set_regs(lanes, a, operation(self.regs(lanes, a), divisor))
+
+    def handle_DIV(self, lanes, a, b):
+        self.divide(lanes, a, b, np.floor_divide)
+
+    def handle_MOD(self, lanes, a, b):
+        self.divide(lanes, a, b, np.remainder)
+
+    def handle_AND(self, lanes, a, b):
+        self.reg[lanes, a] = self.reg[lanes, a] & self.reg[lanes, b]
+
+    def handle_OR(self, lanes, a, b):
+        self.reg[lanes, a] = self.reg[lanes, a] | self.reg[lanes, b]
+
+    def handle_XOR(self, lanes, a, b):
+        self.reg[lanes, a] = self.reg[lanes, a] ^ self.reg[lanes, b]
+
+    def handle_SHL(self, lanes, a, b):
+        # Shifting by 8 or more clears the byte
+        shift = np.minimum(self.regs(lanes, b), 8)
+        self.set_regs(lanes, a, self.regs(lanes, a) << shift)
+
+    def handle_SHR(self, lanes, a, b):
+        shift = np.minimum(self.regs(lanes, b), 8)
+        self.set_regs(lanes, a, self.regs(lanes, a) >> shift)
+
+    def handle_NOT(self, lanes, a, b):
+        self.reg[lanes, a] = ~self.reg[lanes, a]
+
+    def handle_INC(self, lanes, a, b):
+        self.set_regs(lanes, a, self.regs(lanes, a) + 1)
+
+    def handle_DEC(self, lanes, a, b):
+        self.set_regs(lanes, a, self.regs(lanes, a) - 1)
+
+    def handle_CMP(self, lanes, a, b):
+        value_a = self.reg[lanes, a]
+        value_b = self.reg[lanes, b]
+        self.fl[lanes] = np.where(value_a == value_b, 0b001,
+                                  np.where(value_a < value_b, 0b100, 0b010))
+
+    def handle_ADDI(self, lanes, a, b):
+        self.set_regs(lanes, a, self.regs(lanes, a) + b.astype(np.int32))